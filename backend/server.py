@@ -11,13 +11,34 @@ Implements the same endpoints as the original Motoko canister:
 Also serves the frontend static files from /static directory
 """
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_from_directory, send_file, Response, g
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 # --- ADDED IMPORTS / AI SETUP ---
 import re
+import functools
+import hmac
+import random
+import sys
+import shutil
+import struct
+import zipfile
 import json
-from typing import Any, Dict
+import hashlib
+import tempfile
+import threading
+import time
+import uuid
+import wave
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterator
+
+import numpy as np
 
 # --- Google Cloud Secret Manager Setup ---
 def get_secret_value(project_id, secret_id, version_id="1"):
@@ -93,6 +114,13 @@ except Exception as e:
 app = Flask(__name__, static_folder='static', static_url_path='')
 CORS(app)  # Enable CORS for Electron/browser access
 
+# Cloud Run (K_SERVICE is set there) fronts us with one proxy; trust its
+# X-Forwarded-For/-Proto so request.remote_addr is the real client. Elsewhere
+# the header is whatever the client sent, so it's ignored unless configured.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1 if os.environ.get('K_SERVICE') else 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
 # In-memory storage
 user_patterns = {}  # user -> { pattern_name -> pattern }
 user_tempos = {}    # user -> tempo
@@ -103,6 +131,266 @@ def default_pattern():
     return [[False for _ in range(16)] for _ in range(4)]
 
 
+# --- NEW: PRE-SERIALIZED READ BODIES + ETAGS ---
+try:
+    import orjson
+
+    def dumps_json(value: Any) -> bytes:
+        return orjson.dumps(value)
+except ImportError:
+    def dumps_json(value: Any) -> bytes:
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class CachedBody:
+    """A JSON body serialized once at write time, plus its version hash (ETag)."""
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, value: Any):
+        self.body = dumps_json(value)
+        self.etag = hashlib.blake2b(self.body, digest_size=8).hexdigest()
+
+
+pattern_bodies = {}  # (user, pattern_name) -> CachedBody
+tempo_bodies = {}    # user -> CachedBody
+DEFAULT_PATTERN_BODY = CachedBody(default_pattern())
+DEFAULT_TEMPO_BODY = CachedBody(120)
+
+
+def store_pattern(user: str, name: str, pattern: list):
+    """
+    All pattern writes go through here so the cached body never goes stale.
+    Serialize first: if that raises (orjson rejects ints beyond 64 bits), neither
+    dict has been touched.
+    """
+    cached = CachedBody(pattern)
+    user_patterns.setdefault(user, {})[name] = pattern
+    pattern_bodies[(user, name)] = cached
+
+
+def store_tempo(user: str, tempo: int):
+    """All tempo writes go through here; serializes before touching either dict."""
+    cached = CachedBody(tempo)
+    user_tempos[user] = tempo
+    tempo_bodies[user] = cached
+
+
+def cached_json_response(cached: CachedBody):
+    """Serve a CachedBody, answering 304 when the client already has this version."""
+    if request.if_none_match.contains_weak(cached.etag):
+        response = Response(status=304)
+    else:
+        response = Response(cached.body, mimetype='application/json')
+    response.set_etag(cached.etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, never serve stale
+    return response
+
+
+# --- NEW: EDIT HISTORY (periodic snapshots + compact deltas) ---
+HISTORY_SNAPSHOT_EVERY = int(os.environ.get('HISTORY_SNAPSHOT_EVERY', 20))   # full copy every N revisions
+HISTORY_MAX_REVISIONS = int(os.environ.get('HISTORY_MAX_REVISIONS', 500))    # per stream, oldest dropped first
+
+
+def json_diff(old: Any, new: Any, path: tuple = ()) -> list:
+    """
+    Structural diff of two JSON values as a list of ops:
+      ["set", path, value]  replace/insert the value at path
+      ["del", path]         remove a dict key
+      ["len", path, n]      truncate the list at path to n items
+    Pattern edits (a few toggled steps) come out as a handful of "set" ops.
+    Containers are always walked: == would call [1] and [True] equal.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in new.items():
+            if key not in old:
+                ops.append(["set", list(path) + [key], value])
+            else:
+                ops.extend(json_diff(old[key], value, path + (key,)))
+        ops.extend(["del", list(path) + [key]] for key in old if key not in new)
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        for index in range(min(len(old), len(new))):
+            ops.extend(json_diff(old[index], new[index], path + (index,)))
+        ops.extend(["set", list(path) + [index], new[index]] for index in range(len(old), len(new)))
+        if len(new) < len(old):
+            ops.append(["len", list(path), len(new)])
+        return ops
+    if type(old) is type(new) and old == new:
+        return []
+    return [["set", list(path), new]]
+
+
+def json_patch(value: Any, ops: list) -> Any:
+    """Apply json_diff ops in place; returns the (possibly replaced) root."""
+    for op in ops:
+        path = op[1]
+        if op[0] == "set" and not path:
+            value = op[2]
+            continue
+        parent = value
+        for key in path[:-1] if op[0] != "len" else path:
+            parent = parent[key]
+        if op[0] == "len":
+            del parent[op[2]:]
+        elif op[0] == "del":
+            del parent[path[-1]]
+        elif isinstance(parent, list) and path[-1] == len(parent):
+            parent.append(op[2])
+        else:
+            parent[path[-1]] = op[2]
+    return value
+
+
+def _pack(value: Any) -> bytes:
+    return zlib.compress(dumps_json(value), 6)
+
+
+def _unpack(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob))
+
+
+class HistoryStream:
+    """
+    Revisions of one value. Every HISTORY_SNAPSHOT_EVERY-th entry (and any
+    entry whose delta wouldn't be smaller) is a compressed full snapshot; the
+    rest are compressed diffs against the previous revision. Reading any
+    revision decodes one snapshot plus fewer than HISTORY_SNAPSHOT_EVERY deltas.
+    """
+
+    def __init__(self):
+        self.base = 1          # revision number of entries[0]
+        self.entries = []      # (is_snapshot, blob, meta)
+        self.latest = None     # decoded newest value, kept to diff against
+
+    @property
+    def head(self) -> int:
+        return self.base + len(self.entries) - 1
+
+    def append(self, value: Any, meta: Dict[str, Any]) -> int:
+        ops = json_diff(self.latest, value) if self.entries else None
+        if self.entries and not ops:
+            return self.head
+        snapshot = _pack(value)
+        since_snapshot = next((i for i, entry in enumerate(reversed(self.entries)) if entry[0]), None)
+        if since_snapshot is None or since_snapshot + 1 >= HISTORY_SNAPSHOT_EVERY:
+            entry = (True, snapshot, meta)
+        else:
+            delta = _pack(ops)
+            entry = (False, delta, meta) if len(delta) < len(snapshot) else (True, snapshot, meta)
+        self.entries.append(entry)
+        self.latest = json.loads(dumps_json(value))  # private copy, immune to caller mutation
+        self._trim()
+        return self.head
+
+    def _trim(self):
+        # Drop whole snapshot groups from the front so the oldest kept entry is always a snapshot
+        while len(self.entries) > HISTORY_MAX_REVISIONS:
+            cut = next((i for i in range(1, len(self.entries)) if self.entries[i][0]), None)
+            if cut is None:
+                break
+            del self.entries[:cut]
+            self.base += cut
+
+    def get(self, revision: int) -> Any:
+        index = revision - self.base
+        if not 0 <= index < len(self.entries):
+            raise KeyError(revision)
+        start = index
+        while not self.entries[start][0]:
+            start -= 1
+        value = _unpack(self.entries[start][1])
+        for _, blob, _ in self.entries[start + 1:index + 1]:
+            value = json_patch(value, _unpack(blob))
+        return value
+
+    def describe(self) -> list:
+        return [
+            {'revision': self.base + i, 'snapshot': is_snapshot, 'bytes': len(blob), **meta}
+            for i, (is_snapshot, blob, meta) in enumerate(self.entries)
+        ]
+
+
+class HistoryStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.streams = {}   # user -> { stream name -> HistoryStream }
+
+    def record(self, user: str, stream: str, value: Any, source: str) -> int:
+        with self.lock:
+            history = self.streams.setdefault(user, {}).setdefault(stream, HistoryStream())
+            return history.append(value, {'time': time.time(), 'source': source})
+
+    def stream(self, user: str, stream: str):
+        return self.streams.get(user, {}).get(stream)
+
+    def get(self, user: str, stream: str, revision: int) -> Any:
+        with self.lock:
+            history = self.stream(user, stream)
+            if history is None:
+                raise KeyError(stream)
+            return history.get(revision)
+
+
+edit_history = HistoryStore()
+
+
+def records_history(stream: str, input_field: str):
+    """Record a route's successful JSON answer in the caller's history (when a user is given)."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            response = app.make_response(view(*args, **kwargs))
+            data = request.get_json(silent=True) or {}
+            if response.status_code == 200 and data.get('user'):
+                value = {'input': data.get(input_field), 'result': response.get_json()}
+                edit_history.record(str(data['user']), stream, value, source=request.path)
+            return response
+        return wrapper
+    return decorator
+
+
+@app.route('/history/<user>', methods=['GET'])
+def list_history_streams(user):
+    with edit_history.lock:
+        streams = {name: {'head': h.head, 'oldest': h.base, 'revisions': len(h.entries)}
+                   for name, h in edit_history.streams.get(user, {}).items()}
+    return jsonify(streams), 200
+
+
+@app.route('/history/<user>/<stream>', methods=['GET'])
+def list_history(user, stream):
+    with edit_history.lock:
+        history = edit_history.stream(user, stream)
+        if history is None:
+            return jsonify(None), 404
+        return jsonify({'head': history.head, 'revisions': history.describe()}), 200
+
+
+@app.route('/history/<user>/<stream>/<int:revision>', methods=['GET'])
+def get_history_revision(user, stream, revision):
+    try:
+        value = edit_history.get(user, stream, revision)
+    except KeyError:
+        return jsonify(None), 404
+    return jsonify({'revision': revision, 'value': value}), 200
+
+
+@app.route('/history/<user>/<stream>/<int:revision>/restore', methods=['POST'])
+def restore_history_revision(user, stream, revision):
+    """Undo/redo for patterns: make an old revision current (recorded as a new revision)."""
+    if not stream.startswith('pattern:'):
+        return jsonify({"error": "Only pattern history can be restored"}), 400
+    try:
+        pattern = edit_history.get(user, stream, revision)
+    except KeyError:
+        return jsonify(None), 404
+    store_pattern(user, stream[len('pattern:'):], pattern)
+    head = edit_history.record(user, stream, pattern, source=f'restore:{revision}')
+    return jsonify({'revision': head}), 200
+
+
 # --- DUMB REGEX PARSER ---
 ADD_RE   = re.compile(r"^(add|put in)\s+(an?\s+)?(808|kick|snare|hi\s*hat|hihat|clap|bass|piano|pad)$", re.I)
 REMOVE_RE= re.compile(r"^(remove|delete)\s+(the\s+)?(808|kick|snare|hi\s*hat|hihat|clap|bass|piano|pad)$", re.I)
@@ -151,6 +439,158 @@ Only the JSON. No code fences.
     except Exception as e:
         raise RuntimeError(f"OpenAI error: {e}")
 
+# --- NEW: EMBEDDED INTENT CLASSIFIER ---
+# Hashed character n-grams + a linear (softmax) model trained offline by
+# train_intent_model.py. Sits between the regexes and the LLM: only inputs it
+# isn't confident about (or can't fill slots for) are escalated.
+INTENT_MODEL_PATH = os.environ.get('INTENT_MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'intent_model.npz'))
+INTENT_MIN_CONFIDENCE = float(os.environ.get('INTENT_MIN_CONFIDENCE', 0.7))
+INTENT_FEATURES = 4096
+INTENT_NGRAMS = (2, 3, 4)
+INTENT_LABELS = ['add', 'remove', 'mute', 'unmute', 'tempo:set', 'tempo:up', 'tempo:down',
+                 'key:set', 'swing:set', 'unknown']
+
+# Checked in order, so multi-word names win over their prefixes ("bass drum" before "bass")
+INSTRUMENT_ALIASES = [
+    (re.compile(r"\b(808s?|eight\s*oh\s*eight)\b", re.I), '808'),
+    (re.compile(r"\b(kick\s*drums?|kicks?|bass\s*drums?|bd)\b", re.I), 'kick'),
+    (re.compile(r"\b(snare\s*drums?|snares?|sd)\b", re.I), 'snare'),
+    (re.compile(r"\b(hi[\s-]*hats?|high[\s-]*hats?|hats?|hh)\b", re.I), 'hihat'),
+    (re.compile(r"\b(hand\s*claps?|claps?)\b", re.I), 'clap'),
+    (re.compile(r"\b(sub\s*bass|bass\s*lines?|bass)\b", re.I), 'bass'),
+    (re.compile(r"\b(pianos?|keys)\b", re.I), 'piano'),
+    (re.compile(r"\b(synth\s*pads?|pads?)\b", re.I), 'pad'),
+]
+# Any key name: note, optional accidental, optional quality ("c sharp minor", "Am", "g maj")
+KEY_NAME_RE = re.compile(r"\b([a-g])(\s*(?:sharp|flat)\b|#)?(?:\s*(major|maj|minor|min)\b|(m)\b)?", re.I)
+# A bare letter or "Am"/"Em" is only a key right after one of these ("key of g", not "I am")
+KEY_ANCHOR_RE = re.compile(r"\b(key|to|in|into|of|from)\s+$", re.I)
+SUPPORTED_KEYS = {('a', 'minor'): 'A Minor', ('e', 'minor'): 'E Minor', ('c', 'major'): 'C', ('g', 'major'): 'G'}
+NUMBER_RE = re.compile(r"\d+")
+NON_WORD_RE = re.compile(r"[^a-z0-9%#\s]+")
+
+
+def intent_features(text: str):
+    """Hashed, L2-normalized character n-gram counts: (indices, values) arrays."""
+    t = ' ' + ' '.join(NON_WORD_RE.sub(' ', NUMBER_RE.sub('#', text.lower())).split()) + ' '
+    counts = {}
+    for n in INTENT_NGRAMS:
+        for i in range(len(t) - n + 1):
+            h = zlib.crc32(t[i:i + n].encode('utf-8')) % INTENT_FEATURES
+            counts[h] = counts.get(h, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    norm = np.linalg.norm(values)
+    return indices, values / norm if norm else values
+
+
+class IntentClassifier:
+    def __init__(self, path: str):
+        with np.load(path) as model:
+            self.weights = model['weights']   # (INTENT_FEATURES, classes) float32
+            self.bias = model['bias']
+            self.labels = [str(label) for label in model['labels']]
+
+    def predict(self, text: str):
+        """Return (label, probability) for the most likely intent."""
+        indices, values = intent_features(text)
+        logits = values @ self.weights[indices] + self.bias
+        logits = np.exp(logits - logits.max())
+        probs = logits / logits.sum()
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+
+def _mentioned_instruments(text: str):
+    """Distinct instruments named in text, ordered by where they first appear."""
+    claimed, first_seen = [], {}
+    for pattern, instrument in INSTRUMENT_ALIASES:
+        for m in pattern.finditer(text):
+            # Aliases are checked longest-first, so "bass drum" keeps "bass" from matching again
+            if any(m.start() < end and start < m.end() for start, end in claimed):
+                continue
+            claimed.append(m.span())
+            first_seen[instrument] = min(first_seen.get(instrument, m.start()), m.start())
+    return sorted(first_seen, key=first_seen.get)
+
+
+def _mentioned_keys(text: str):
+    """
+    Distinct keys named in text, ordered by position. Keys the DAW doesn't
+    support appear as None so they still count as a mention.
+    """
+    keys = []
+    for m in KEY_NAME_RE.finditer(text):
+        note, accidental, quality, short_minor = m.groups()
+        if not (accidental or quality) and not KEY_ANCHOR_RE.search(text[:m.start()]):
+            continue
+        quality = 'minor' if short_minor or (quality or '').lower().startswith('min') else 'major'
+        name = (note.lower(), accidental.strip().lower() if accidental else '', quality)
+        if name not in keys:
+            keys.append(name)
+    return [None if accidental else SUPPORTED_KEYS.get((note, quality)) for note, accidental, quality in keys]
+
+
+def _only_number(text: str, lo: int, hi: int, default=None):
+    """
+    The single number in text if it lies in [lo, hi], default when there is
+    none, and None when there are several or one is out of range.
+    """
+    numbers = [int(m.group()) for m in NUMBER_RE.finditer(text)]
+    if not numbers:
+        return default
+    if len(numbers) > 1 or not lo <= numbers[0] <= hi:
+        return None
+    return numbers[0]
+
+
+def intent_plan(label: str, text: str):
+    """Fill the slots for a predicted intent. None means the slots can't be trusted."""
+    if label in ('add', 'remove', 'mute', 'unmute'):
+        instruments = _mentioned_instruments(text)
+        # "remove the snare but keep the kick" names two; leave that to the LLM
+        if len(instruments) != 1:
+            return None
+        return {"type": label, "instrument": instruments[0]}
+    if label == 'tempo:set':
+        bpm = _only_number(text, 40, 220)
+        return {"type": "tempo:set", "bpm": bpm} if bpm is not None else None
+    if label in ('tempo:up', 'tempo:down'):
+        delta = _only_number(text, 1, 50, default=5)   # "a bit faster" with no amount
+        if delta is None:
+            return None
+        return {"type": "tempo:delta", "delta": delta if label == 'tempo:up' else -delta}
+    if label == 'key:set':
+        keys = _mentioned_keys(text)
+        # "from E minor to C major" names two; leave that to the LLM
+        if len(keys) != 1 or keys[0] is None:
+            return None
+        return {"type": "key:set", "key": keys[0]}
+    if label == 'swing:set':
+        percent = _only_number(text, 50, 65)
+        return {"type": "swing:set", "percent": percent} if percent is not None else None
+    return None
+
+
+def classify_command(text: str):
+    """Return (plan or None, confidence). plan is None when the LLM should decide."""
+    if intent_classifier is None:
+        return None, 0.0
+    label, confidence = intent_classifier.predict(text)
+    if confidence < INTENT_MIN_CONFIDENCE:
+        return None, confidence
+    return intent_plan(label, text), confidence
+
+
+intent_classifier = None
+try:
+    intent_classifier = IntentClassifier(INTENT_MODEL_PATH)
+    print(f"[STARTUP] Intent classifier loaded ({len(intent_classifier.labels)} intents)")
+except FileNotFoundError:
+    print(f"[STARTUP] No intent model at {INTENT_MODEL_PATH}; run train_intent_model.py")
+except Exception as e:
+    print(f"[ERROR] Failed to load intent model: {e}")
+
 # Serve frontend
 @app.route('/')
 def serve_frontend():
@@ -168,19 +608,16 @@ def serve_static(path):
 
 @app.route('/defaultPattern', methods=['GET'])
 def get_default_pattern():
-    return jsonify(default_pattern())
+    return cached_json_response(DEFAULT_PATTERN_BODY)
 
 
 @app.route('/pattern/<user>/<name>', methods=['GET'])
 def get_pattern(user, name):
-    if user not in user_patterns:
-        return jsonify(None), 404
-    
-    patterns = user_patterns[user]
-    if name not in patterns:
+    cached = pattern_bodies.get((user, name))
+    if cached is None:
         return jsonify(None), 404
     
-    return jsonify(patterns[name])
+    return cached_json_response(cached)
 
 
 @app.route('/pattern/<user>/<name>', methods=['POST'])
@@ -192,11 +629,9 @@ def save_pattern(user, name):
         if not isinstance(pattern, list):
             return jsonify({"error": "Pattern must be an array"}), 400
         
-        if user not in user_patterns:
-            user_patterns[user] = {}
-        
-        user_patterns[user][name] = pattern
-        return jsonify({}), 200
+        store_pattern(user, name, pattern)
+        revision = edit_history.record(user, f'pattern:{name}', pattern, source='save')
+        return jsonify({"revision": revision}), 200
     
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -204,8 +639,7 @@ def save_pattern(user, name):
 
 @app.route('/tempo/<user>', methods=['GET'])
 def get_tempo(user):
-    tempo = user_tempos.get(user, 120)  # Default tempo is 120
-    return jsonify(tempo)
+    return cached_json_response(tempo_bodies.get(user, DEFAULT_TEMPO_BODY))  # Default tempo is 120
 
 
 @app.route('/tempo/<user>', methods=['POST'])
@@ -217,7 +651,7 @@ def set_tempo(user):
         if not isinstance(tempo, int) or tempo <= 0:
             return jsonify({"error": "Tempo must be a positive integer"}), 400
         
-        user_tempos[user] = tempo
+        store_tempo(user, tempo)
         return jsonify({}), 200
     
     except Exception as e:
@@ -229,28 +663,183 @@ def health():
     return jsonify({"status": "ok"}), 200
 
 
+# --- NEW: ADMISSION CONTROL FOR AI ROUTES ---
+AI_GLOBAL_RATE = float(os.environ.get('AI_GLOBAL_RATE', 5))      # upstream calls/sec across all users
+AI_GLOBAL_BURST = int(os.environ.get('AI_GLOBAL_BURST', 10))
+AI_USER_RATE = float(os.environ.get('AI_USER_RATE', 0.5))        # upstream calls/sec per user
+AI_USER_BURST = int(os.environ.get('AI_USER_BURST', 5))
+AI_MAX_INFLIGHT = int(os.environ.get('AI_MAX_INFLIGHT', 8))      # concurrent upstream calls
+AI_QUEUE_SIZE = int(os.environ.get('AI_QUEUE_SIZE', 32))         # requests allowed to wait
+AI_MAX_WAIT = float(os.environ.get('AI_MAX_WAIT', 5))            # seconds before degrading
+AI_TRACKED_USERS = 10000                                         # per-user buckets kept (LRU)
+
+
+class TokenBucket:
+    """Classic token bucket. Not thread-safe on its own; callers hold a lock."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        """Give back a token whose request never went upstream."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Seconds until the next token is available."""
+        self._refill()
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AIAdmission:
+    """
+    Gate in front of Gemini/OpenAI calls: a per-user bucket, then a global
+    bucket plus an in-flight cap. Requests that can't go straight through wait
+    in a bounded queue for up to AI_MAX_WAIT seconds. acquire() returns None
+    when admitted, otherwise the reason the caller should degrade.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.global_bucket = TokenBucket(AI_GLOBAL_RATE, AI_GLOBAL_BURST)
+        self.user_buckets = OrderedDict()
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'queued': 0, 'userRateLimited': 0, 'queueFull': 0, 'timedOut': 0}
+
+    def _user_bucket(self, user: str) -> TokenBucket:
+        bucket = self.user_buckets.get(user)
+        if bucket is None:
+            bucket = self.user_buckets[user] = TokenBucket(AI_USER_RATE, AI_USER_BURST)
+            if len(self.user_buckets) > AI_TRACKED_USERS:
+                self.user_buckets.popitem(last=False)
+        else:
+            self.user_buckets.move_to_end(user)
+        return bucket
+
+    def _try_admit(self) -> bool:
+        if self.in_flight < AI_MAX_INFLIGHT and self.global_bucket.take():
+            self.in_flight += 1
+            self.stats['admitted'] += 1
+            return True
+        return False
+
+    def acquire(self, user: str):
+        with self.cond:
+            user_bucket = self._user_bucket(user)
+            if not user_bucket.take():
+                self.stats['userRateLimited'] += 1
+                return 'user_rate_limited'
+            if self._try_admit():
+                return None
+            # Degraded requests never reach the AI, so they don't count against the user
+            if self.waiting >= AI_QUEUE_SIZE:
+                self.stats['queueFull'] += 1
+                user_bucket.refund()
+                return 'queue_full'
+
+            self.waiting += 1
+            self.stats['queued'] += 1
+            deadline = time.monotonic() + AI_MAX_WAIT
+            try:
+                while True:
+                    if self._try_admit():
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timedOut'] += 1
+                        user_bucket.refund()
+                        return 'timeout'
+                    # Wake on release() or when the next global token is due
+                    self.cond.wait(min(remaining, self.global_bucket.wait_time() or remaining))
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                'queueDepth': self.waiting,
+                'queueLimit': AI_QUEUE_SIZE,
+                'inFlight': self.in_flight,
+                'inFlightLimit': AI_MAX_INFLIGHT,
+                'trackedUsers': len(self.user_buckets),
+                **self.stats,
+            }
+
+
+ai_admission = AIAdmission()
+
+
+def ai_user_key() -> str:
+    """
+    Who to bill the per-user bucket to: the client address. A body "user" or
+    X-User header is unauthenticated, so honouring it would let one client
+    mint a fresh bucket per request.
+    """
+    return request.remote_addr or 'anonymous'
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"aiAdmission": ai_admission.snapshot()}), 200
+
+
 # --- NEW: AI / RULES COMMAND ROUTE ---
 @app.route('/api/command', methods=['POST'])
+@records_history('commands', 'text')
 def command_agent():
     data = request.get_json(silent=True) or {}
     text = data.get('text', '').strip()
     if not text:
         return jsonify({"error":"text required"}), 400
+    # cheapest first: exact regexes, then the local classifier, then the LLM
+    plan = parse_command(text)
+    if plan["type"] != "unknown":
+        return jsonify({"plan": plan, "source": "rules"})
+    classified, confidence = classify_command(text)
+    if classified:
+        return jsonify({"plan": classified, "source": "classifier", "confidence": round(confidence, 3)})
     if USE_AI:
+        rejected = ai_admission.acquire(ai_user_key())
+        if rejected:
+            # over capacity: answer locally instead of queueing on OpenAI
+            return jsonify({"plan": plan, "source": "rules", "degraded": rejected}), 200
         try:
             plan = ai_plan_from_text(text)
             return jsonify({"plan": plan, "source": "ai"})
         except Exception as e:
             # graceful fallback to rules
-            plan = parse_command(text)
             return jsonify({"plan": plan, "source": "rules", "ai_error": str(e)}), 200
+        finally:
+            ai_admission.release()
     # no key: use rules
-    plan = parse_command(text)
     return jsonify({"plan": plan, "source": "rules"})
 
 
 # --- NEW: AI-POWERED SYNTH PARAMETER GENERATION ---
 @app.route('/api/generate-synth-params', methods=['POST'])
+@records_history('synth-params', 'prompt')
 def generate_synth_params():
     """
     Uses Google Gemini to generate synth parameters based on user description.
@@ -271,6 +860,11 @@ def generate_synth_params():
         # Fallback to sensible defaults based on simple keyword matching
         return fallback_synth_params(prompt)
     
+    rejected = ai_admission.acquire(ai_user_key())
+    if rejected:
+        print(f"[API] Using fallback - admission rejected ({rejected})")
+        return fallback_synth_params(prompt)
+    
     try:
         # Construct the AI prompt for Gemini
         ai_prompt = f"""You are an expert sound designer with deep knowledge of synthesis parameters. Create unique and musically interesting synth parameters for: "{prompt}"
@@ -374,6 +968,8 @@ Return ONLY the JSON object:"""
     except Exception as e:
         print(f"Error generating synth params with Gemini: {e}")
         return fallback_synth_params(prompt)
+    finally:
+        ai_admission.release()
 
 
 def fallback_synth_params(prompt: str) -> tuple:
@@ -451,6 +1047,7 @@ def fallback_synth_params(prompt: str) -> tuple:
 
 # --- NEW: AI-POWERED FULL SYNTH SETTINGS GENERATION ---
 @app.route('/api/generate-synth-settings', methods=['POST'])
+@records_history('synth-settings', 'prompt')
 def generate_synth_settings():
     """
     Uses Google Gemini to generate complete synthesizer settings based on user description.
@@ -469,6 +1066,11 @@ def generate_synth_settings():
         print("[API] Using fallback - Gemini not available")
         return fallback_synth_settings(prompt)
     
+    rejected = ai_admission.acquire(ai_user_key())
+    if rejected:
+        print(f"[API] Using fallback - admission rejected ({rejected})")
+        return fallback_synth_settings(prompt)
+    
     try:
         # Construct the AI prompt for Gemini
         ai_prompt = f"""You are an expert synthesizer designer with deep knowledge of sound synthesis. Create unique and musically interesting synth settings for: "{prompt}"
@@ -583,6 +1185,8 @@ Return ONLY the JSON object:"""
     except Exception as e:
         print(f"[ERROR] Error generating synth settings with Gemini: {e}")
         return fallback_synth_settings(prompt)
+    finally:
+        ai_admission.release()
 
 
 def fallback_synth_settings(prompt: str):
@@ -664,6 +1268,1453 @@ def fallback_synth_settings(prompt: str):
     
     return jsonify(settings), 200
 
+# --- NEW: SERVER-SIDE RENDERING + WAVEFORM PEAK SUMMARIES ---
+RENDER_SAMPLE_RATE = 44100
+RENDER_CHUNK = 65536          # samples rendered per block; bounds peak memory
+MAX_RENDER_SECONDS = 600      # hard cap so a single request can't render forever
+RENDER_MIN_TEMPO = 20         # BPM range accepted for rendering; hits per chunk grow with tempo
+RENDER_MAX_TEMPO = 400
+PEAK_BLOCK = 256              # samples per peak at the finest pyramid level
+PEAK_CACHE_SIZE = 128         # number of pyramids kept in the LRU cache
+PEAK_MAX_PER_RESPONSE = 8192  # peaks returned per window request
+
+# Row order of the 4x16 grid used by the DrumMachine page
+DRUM_TRACKS = ['kick', 'snare', 'hihat', 'clap']
+
+peak_cache = OrderedDict()    # content hash -> peak pyramid
+peak_cache_lock = threading.Lock()
+
+
+def content_hash(payload: Any) -> str:
+    """Stable hash of a JSON-serializable payload (key order independent)."""
+    blob = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def _noise(rng: np.random.Generator, n: int) -> np.ndarray:
+    return rng.random(n, dtype=np.float32) * 2 - 1
+
+
+def _drum_voice(kind: str, sample_rate: int) -> np.ndarray:
+    """One-shot drum hits, mirroring AudioEngine.generateDrumSound in the frontend."""
+    rng = np.random.default_rng(DRUM_TRACKS.index(kind) if kind in DRUM_TRACKS else 0)
+    durations = {'kick': 0.5, 'snare': 0.3, 'hihat': 0.1, 'clap': 0.2}
+    n = int(sample_rate * durations.get(kind, 0.1))
+    t = np.arange(n, dtype=np.float32) / sample_rate
+
+    if kind == 'kick':
+        freq = 150 * np.exp(-t * 10)
+        return (np.sin(2 * np.pi * freq * t) * np.exp(-t * 5)).astype(np.float32)
+    if kind == 'snare':
+        tone = np.sin(2 * np.pi * 200 * t) * 0.3
+        return ((_noise(rng, n) * 0.5 + tone) * np.exp(-t * 15)).astype(np.float32)
+    if kind == 'hihat':
+        return (_noise(rng, n) * np.exp(-t * 40) * 0.3).astype(np.float32)
+    if kind == 'clap':
+        envelope = np.exp(-t * 20) * (1 + np.sin(t * 100) * 0.5)
+        return (_noise(rng, n) * envelope * 0.4).astype(np.float32)
+    return np.zeros(n, dtype=np.float32)
+
+
+def render_synth_chunks(params: Dict[str, Any], sample_rate: int = RENDER_SAMPLE_RATE) -> Iterator[np.ndarray]:
+    """
+    Render synth params (the /api/generate-synth-params shape) block by block.
+    Same waveform/ADSR math as AudioEngine.createSampleFromJSON.
+    """
+    duration = min(float(params.get('duration', 0.5)), MAX_RENDER_SECONDS)
+    waveform = str(params.get('waveform', 'sine')).lower()
+    frequency = float(params.get('frequency', 440))
+    amplitude = float(params.get('amplitude', 0.5))
+    env = params.get('envelope') or {}
+    attack = max(float(env.get('attack', 0.01)), 1e-6)
+    decay = max(float(env.get('decay', 0.1)), 1e-6)
+    sustain = float(env.get('sustain', 0.7))
+    release = max(float(env.get('release', 0.2)), 1e-6)
+    harmonics = params.get('harmonics') or []
+
+    total = int(sample_rate * duration)
+    release_start = duration - release
+    rng = np.random.default_rng(int(content_hash(params)[:8], 16))
+
+    for start in range(0, total, RENDER_CHUNK):
+        n = min(RENDER_CHUNK, total - start)
+        t = (start + np.arange(n, dtype=np.float64)) / sample_rate
+
+        envelope = np.select(
+            [t < attack, t < attack + decay, t < release_start],
+            [t / attack, 1 - ((t - attack) / decay) * (1 - sustain), sustain],
+            sustain * (1 - (t - release_start) / release),
+        )
+
+        phase = 2 * np.pi * frequency * t
+        if waveform == 'square':
+            sample = np.sign(np.sin(phase))
+        elif waveform == 'sawtooth':
+            sample = 2 * np.mod(frequency * t, 1) - 1
+        elif waveform == 'triangle':
+            sample = 4 * np.abs(np.mod(frequency * t, 1) - 0.5) - 1
+        elif waveform == 'noise':
+            sample = _noise(rng, n)
+        else:
+            sample = np.sin(phase)
+
+        for harmonic in harmonics:
+            sample = sample + np.sin(2 * np.pi * float(harmonic.get('frequency', 0)) * t) * float(harmonic.get('amplitude', 0))
+
+        yield (sample * envelope * amplitude).astype(np.float32)
+
+
+def render_pattern_chunks(pattern: list, tempo: int, loops: int = 1,
+                          sample_rate: int = RENDER_SAMPLE_RATE) -> Iterator[np.ndarray]:
+    """
+    Bounce a step pattern block by block. Rows follow DRUM_TRACKS; extra rows
+    (custom tracks whose samples live only in the browser) are skipped.
+    """
+    tempo = min(max(int(tempo), RENDER_MIN_TEMPO), RENDER_MAX_TEMPO)  # routes reject these; stay bounded anyway
+    step_samples = sample_rate * 60.0 / tempo / 4  # 16th notes
+    steps = max((len(row) for row in pattern), default=0)
+    voices = [_drum_voice(kind, sample_rate) for kind in DRUM_TRACKS]
+    longest = max(len(v) for v in voices)
+    loops = max(int(loops), 1)
+    if steps:
+        # Never schedule more loops than fit under the render cap
+        loops = min(loops, int(MAX_RENDER_SECONDS * sample_rate // (steps * step_samples)) + 1)
+    # Tracks hit on each step of one loop; hits are generated per chunk from this
+    active = [[track for track, row in enumerate(pattern[:len(voices)]) if step < len(row) and row[step]]
+              for step in range(steps)]
+    total_steps = loops * steps
+
+    body = int(round(total_steps * step_samples))
+    total = min(body + longest, MAX_RENDER_SECONDS * sample_rate)
+
+    for start in range(0, total, RENDER_CHUNK):
+        n = min(RENDER_CHUNK, total - start)
+        out = np.zeros(n, dtype=np.float32)
+        # Only steps whose voices can still be sounding inside [start, start + n)
+        first = max(int(np.floor((start - longest) / step_samples)), 0)
+        last = min(int(np.ceil((start + n) / step_samples)), total_steps)
+        for index in range(first, last):
+            onset = int(round(index * step_samples))
+            for track in active[index % steps]:
+                voice = voices[track]
+                lo = max(start, onset)
+                hi = min(start + n, onset + len(voice))
+                if hi > lo:
+                    out[lo - start:hi - start] += voice[lo - onset:hi - onset]
+        yield out
+
+
+def build_peak_pyramid(chunks: Iterator[np.ndarray], sample_rate: int) -> Dict[str, Any]:
+    """
+    Reduce a stream of sample blocks to a min/max/RMS pyramid.
+    Level 0 holds one peak per PEAK_BLOCK samples; each level above halves it.
+    Only the peak arrays are kept, never the audio itself.
+    """
+    mins, maxs, sumsq = [], [], []
+    counts = []
+    carry = np.zeros(0, dtype=np.float32)
+    length = 0
+
+    for chunk in chunks:
+        length += len(chunk)
+        data = np.concatenate([carry, chunk]) if len(carry) else chunk
+        usable = len(data) - len(data) % PEAK_BLOCK
+        blocks = data[:usable].reshape(-1, PEAK_BLOCK)
+        if len(blocks):
+            mins.append(blocks.min(axis=1))
+            maxs.append(blocks.max(axis=1))
+            sumsq.append(np.square(blocks, dtype=np.float64).sum(axis=1))
+            counts.append(np.full(len(blocks), PEAK_BLOCK, dtype=np.int64))
+        carry = data[usable:]
+
+    if len(carry):
+        mins.append(np.array([carry.min()], dtype=np.float32))
+        maxs.append(np.array([carry.max()], dtype=np.float32))
+        sumsq.append(np.array([np.square(carry, dtype=np.float64).sum()]))
+        counts.append(np.array([len(carry)], dtype=np.int64))
+
+    lo = np.concatenate(mins) if mins else np.zeros(0, dtype=np.float32)
+    hi = np.concatenate(maxs) if maxs else np.zeros(0, dtype=np.float32)
+    sq = np.concatenate(sumsq) if sumsq else np.zeros(0)
+    cnt = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+    levels = []
+    samples_per_peak = PEAK_BLOCK
+    while True:
+        levels.append({
+            'samplesPerPeak': samples_per_peak,
+            'min': lo,
+            'max': hi,
+            'rms': np.sqrt(sq / np.maximum(cnt, 1)).astype(np.float32),
+        })
+        if len(lo) <= 1:
+            break
+        if len(lo) % 2:
+            # Pad with a neutral entry so pairs line up
+            lo = np.append(lo, lo[-1])
+            hi = np.append(hi, hi[-1])
+            sq = np.append(sq, 0.0)
+            cnt = np.append(cnt, 0)
+        lo = np.minimum(lo[0::2], lo[1::2])
+        hi = np.maximum(hi[0::2], hi[1::2])
+        sq = sq[0::2] + sq[1::2]
+        cnt = cnt[0::2] + cnt[1::2]
+        samples_per_peak *= 2
+
+    return {'sampleRate': sample_rate, 'length': length, 'levels': levels}
+
+
+def get_peak_pyramid(key: str):
+    with peak_cache_lock:
+        pyramid = peak_cache.get(key)
+        if pyramid is not None:
+            peak_cache.move_to_end(key)
+        return pyramid
+
+
+def store_peak_pyramid(key: str, pyramid: Dict[str, Any]):
+    with peak_cache_lock:
+        peak_cache[key] = pyramid
+        peak_cache.move_to_end(key)
+        while len(peak_cache) > PEAK_CACHE_SIZE:
+            peak_cache.popitem(last=False)
+
+
+def serialize_pyramid(key: str, pyramid: Dict[str, Any], window=None) -> Dict[str, Any]:
+    """
+    Pyramid metadata, plus one level's peaks for a sample window when
+    window=(level, start, end) is given. Only the requested slice is converted
+    to JSON, so zooming costs time proportional to what's on screen.
+    """
+    body = {
+        'hash': key,
+        'sampleRate': pyramid['sampleRate'],
+        'length': pyramid['length'],
+        'levels': [{'samplesPerPeak': lvl['samplesPerPeak'], 'peaks': len(lvl['min'])}
+                   for lvl in pyramid['levels']],
+    }
+    if window is not None:
+        level, start, end = window
+        lvl = pyramid['levels'][level]
+        spp = lvl['samplesPerPeak']
+        first = start // spp
+        last = min(-(-end // spp), len(lvl['min']), first + PEAK_MAX_PER_RESPONSE)
+        body['window'] = {
+            'level': level,
+            'samplesPerPeak': spp,
+            'start': first * spp,
+            'end': min(last * spp, pyramid['length']),
+            'min': np.round(lvl['min'][first:last], 4).tolist(),
+            'max': np.round(lvl['max'][first:last], 4).tolist(),
+            'rms': np.round(lvl['rms'][first:last], 4).tolist(),
+        }
+    return body
+
+
+def _int_arg(name: str, default: int):
+    raw = request.args.get(name)
+    if raw is None:
+        return default
+    return int(raw)
+
+
+def _peak_window_args(pyramid: Dict[str, Any]):
+    """Parse ?level=N&start=S&end=E (sample offsets); returns (window or None, error_response)."""
+    try:
+        level = _int_arg('level', None)
+        start = _int_arg('start', 0)
+        end = _int_arg('end', pyramid['length'])
+    except ValueError:
+        return None, (jsonify({"error": "level, start and end must be integers"}), 400)
+    if level is None:
+        return None, None
+    if not 0 <= level < len(pyramid['levels']):
+        return None, (jsonify({"error": f"level must be between 0 and {len(pyramid['levels']) - 1}"}), 400)
+    if not 0 <= start < end:
+        return None, (jsonify({"error": "start must be >= 0 and less than end"}), 400)
+    return (level, start, end), None
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def valid_render_tempo(tempo: Any) -> bool:
+    return isinstance(tempo, int) and not isinstance(tempo, bool) and RENDER_MIN_TEMPO <= tempo <= RENDER_MAX_TEMPO
+
+
+def validate_synth_params(params: Any):
+    """Return an error message if params can't be rendered, else None."""
+    if not isinstance(params, dict):
+        return "synth params must be an object"
+    for field in ('duration', 'frequency', 'amplitude'):
+        if field in params and not _is_number(params[field]):
+            return f"{field} must be a number"
+    if 'waveform' in params and not isinstance(params['waveform'], str):
+        return "waveform must be a string"
+    envelope = params.get('envelope')
+    if envelope is not None:
+        if not isinstance(envelope, dict):
+            return "envelope must be an object"
+        for field in ('attack', 'decay', 'sustain', 'release'):
+            if field in envelope and not _is_number(envelope[field]):
+                return f"envelope.{field} must be a number"
+    harmonics = params.get('harmonics')
+    if harmonics is not None:
+        if not isinstance(harmonics, list) or len(harmonics) > 64:
+            return "harmonics must be a list of at most 64 items"
+        for harmonic in harmonics:
+            if not isinstance(harmonic, dict) or not all(
+                    _is_number(harmonic.get(f, 0)) for f in ('frequency', 'amplitude')):
+                return "each harmonic must be an object with numeric frequency and amplitude"
+    return None
+
+
+@app.route('/api/waveform/peaks', methods=['POST'])
+def waveform_peaks():
+    """
+    Build (or reuse) a min/max/RMS peak pyramid for rendered audio.
+    Body is one of:
+      { "synth": {...synth params...} }
+      { "pattern": [[bool]], "tempo": 120, "loops": 1 }
+      { "user": "...", "name": "...", "loops": 1 }   (stored pattern + stored tempo)
+    Returns the hash and level layout; add ?level=N[&start=&end=] to also get
+    one level's peaks for a window of samples.
+    """
+    data = request.get_json(silent=True) or {}
+    sample_rate = data.get('sampleRate', RENDER_SAMPLE_RATE)
+    if not isinstance(sample_rate, int) or isinstance(sample_rate, bool) or not 8000 <= sample_rate <= 96000:
+        return jsonify({"error": "sampleRate must be an integer between 8000 and 96000"}), 400
+
+    if 'synth' in data:
+        error = validate_synth_params(data['synth'])
+        if error:
+            return jsonify({"error": error}), 400
+        source = {'synth': data['synth']}
+    else:
+        pattern = data.get('pattern')
+        tempo = data.get('tempo')
+        if pattern is None and 'user' in data and 'name' in data:
+            pattern = user_patterns.get(data['user'], {}).get(data['name'])
+            if pattern is None:
+                return jsonify({"error": "Pattern not found"}), 404
+            if tempo is None:
+                tempo = user_tempos.get(data['user'], 120)
+        if not isinstance(pattern, list) or not all(isinstance(row, list) for row in pattern):
+            return jsonify({"error": "synth params or a pattern (array of arrays) are required"}), 400
+        if tempo is None:
+            tempo = 120
+        if not valid_render_tempo(tempo):
+            return jsonify({"error": f"Tempo must be an integer between {RENDER_MIN_TEMPO} and {RENDER_MAX_TEMPO}"}), 400
+        loops = data.get('loops', 1)
+        if not isinstance(loops, int) or isinstance(loops, bool) or loops < 1:
+            return jsonify({"error": "loops must be a positive integer"}), 400
+        source = {'pattern': pattern, 'tempo': tempo, 'loops': loops}
+
+    key = content_hash({'source': source, 'sampleRate': sample_rate})
+    pyramid = get_peak_pyramid(key)
+    cached = pyramid is not None
+    if not cached:
+        try:
+            if 'synth' in source:
+                chunks = render_synth_chunks(source['synth'], sample_rate)
+            else:
+                chunks = render_pattern_chunks(source['pattern'], source['tempo'], source['loops'], sample_rate)
+            pyramid = build_peak_pyramid(chunks, sample_rate)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"Could not render audio: {e}"}), 400
+        store_peak_pyramid(key, pyramid)
+
+    window, error = _peak_window_args(pyramid)
+    if error:
+        return error
+    body = serialize_pyramid(key, pyramid, window)
+    body['cached'] = cached
+    return jsonify(body), 200
+
+
+@app.route('/api/waveform/peaks/<key>', methods=['GET'])
+def waveform_peaks_cached(key):
+    """Fetch a window of one level from a cached pyramid (cheap zoom lookups)."""
+    pyramid = get_peak_pyramid(key)
+    if pyramid is None:
+        return jsonify({"error": "Unknown or expired peak hash"}), 404
+    window, error = _peak_window_args(pyramid)
+    if error:
+        return error
+    return jsonify(serialize_pyramid(key, pyramid, window)), 200
+
+
+# --- NEW: SAMPLE LIBRARY (canonical PCM on disk, mmap reads, Range serving) ---
+SAMPLE_DIR = os.environ.get('SAMPLE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples'))
+SAMPLE_RATE = RENDER_SAMPLE_RATE   # canonical storage: 16-bit PCM WAV at this rate
+SAMPLE_MAX_UPLOAD = int(os.environ.get('SAMPLE_MAX_UPLOAD_MB', 200)) * 1024 * 1024
+SAMPLE_READ_FRAMES = 65536         # frames decoded per block during upload
+SAMPLE_PCM_MAX_FRAMES = 1 << 20    # frames returned per /pcm request
+SAMPLE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+sample_index = {}   # sample_id -> metadata dict
+sample_index_lock = threading.Lock()
+
+
+def _sample_index_path() -> str:
+    return os.path.join(SAMPLE_DIR, 'index.json')
+
+
+def _sample_path(sample_id: str) -> str:
+    return os.path.join(SAMPLE_DIR, f'{sample_id}.wav')
+
+
+def load_sample_index():
+    """Load the metadata index written by previous runs (audio stays on disk)."""
+    try:
+        with open(_sample_index_path()) as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"[SAMPLES] Could not read sample index: {e}")
+        return
+    with sample_index_lock:
+        sample_index.clear()
+        sample_index.update({e['id']: e for e in entries if os.path.exists(_sample_path(e['id']))})
+        loaded = len(sample_index)
+    print(f"[SAMPLES] Loaded {loaded} samples from {SAMPLE_DIR}")
+
+
+def _write_sample_index():
+    # Caller holds sample_index_lock. Write-then-rename so readers never see half a file.
+    os.makedirs(SAMPLE_DIR, exist_ok=True)
+    tmp = _sample_index_path() + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(list(sample_index.values()), f)
+    os.replace(tmp, _sample_index_path())
+
+
+def _pcm_to_float(raw: bytes, sample_width: int, channels: int) -> np.ndarray:
+    """Decode interleaved little-endian PCM into a (frames, channels) float32 array."""
+    if sample_width == 1:
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        data = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        ints = np.where(ints & 0x800000, ints - 0x1000000, ints)
+        data = ints.astype(np.float32) / 8388608
+    elif sample_width == 4:
+        data = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width * 8} bits")
+    return data.reshape(-1, channels)
+
+
+class _LinearResampler:
+    """Streaming linear-interpolation resampler that keeps state across blocks."""
+
+    def __init__(self, src_rate: int, dst_rate: int, channels: int):
+        self.step = src_rate / dst_rate
+        self.out_index = 0       # next output frame to produce
+        self.in_offset = 0       # global index of self.tail[0]
+        self.tail = np.zeros((0, channels), dtype=np.float32)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        buf = np.concatenate([self.tail, block]) if len(self.tail) else block
+        if len(buf) < 2:
+            self.tail = buf
+            return np.zeros((0, buf.shape[1]), dtype=np.float32)
+        last_pos = self.in_offset + len(buf) - 1
+        out_end = int(np.floor(last_pos / self.step)) + 1
+        positions = np.arange(self.out_index, out_end) * self.step - self.in_offset
+        xp = np.arange(len(buf))
+        out = np.stack([np.interp(positions, xp, buf[:, c]) for c in range(buf.shape[1])], axis=1)
+        self.out_index = out_end
+        self.in_offset += len(buf) - 1
+        self.tail = buf[-1:]
+        return out.astype(np.float32)
+
+
+def decode_to_canonical(src, dest_path: str) -> Dict[str, Any]:
+    """
+    Decode a PCM WAV stream into canonical 16-bit WAV at SAMPLE_RATE, block by
+    block, so the upload is never fully held in memory. Returns metadata.
+    """
+    try:
+        reader = wave.open(src, 'rb')
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Unsupported audio file (PCM WAV required): {e}")
+
+    with reader:
+        channels = reader.getnchannels()
+        width = reader.getsampwidth()
+        src_rate = reader.getframerate()
+        if channels not in (1, 2):
+            raise ValueError("Only mono and stereo samples are supported")
+
+        resampler = _LinearResampler(src_rate, SAMPLE_RATE, channels) if src_rate != SAMPLE_RATE else None
+        digest = hashlib.sha256()
+        frames = 0
+        peak = 0.0
+
+        with wave.open(dest_path, 'wb') as writer:
+            writer.setnchannels(channels)
+            writer.setsampwidth(2)
+            writer.setframerate(SAMPLE_RATE)
+            while True:
+                raw = reader.readframes(SAMPLE_READ_FRAMES)
+                if not raw:
+                    break
+                block = _pcm_to_float(raw, width, channels)
+                if resampler:
+                    block = resampler.process(block)
+                if not len(block):
+                    continue
+                pcm = (np.clip(block, -1.0, 1.0) * 32767).astype('<i2')
+                out = pcm.tobytes()
+                writer.writeframesraw(out)
+                digest.update(out)
+                frames += len(pcm)
+                peak = max(peak, float(np.abs(block).max()))
+
+    data_bytes = frames * channels * 2
+    return {
+        'channels': channels,
+        'sampleRate': SAMPLE_RATE,
+        'sourceSampleRate': src_rate,
+        'sourceBitDepth': width * 8,
+        'frames': frames,
+        'duration': frames / SAMPLE_RATE,
+        'peak': round(peak, 4),
+        'bytes': os.path.getsize(dest_path),
+        'dataOffset': os.path.getsize(dest_path) - data_bytes,
+        'sha256': digest.hexdigest(),
+    }
+
+
+def sample_memmap(meta: Dict[str, Any]) -> np.ndarray:
+    """Map a stored sample's PCM as a read-only (frames, channels) int16 array."""
+    if meta['frames'] == 0:
+        return np.zeros((0, meta['channels']), dtype='<i2')
+    return np.memmap(_sample_path(meta['id']), dtype='<i2', mode='r', offset=meta['dataOffset'],
+                     shape=(meta['frames'], meta['channels']))
+
+
+def _get_sample(user: str, sample_id: str):
+    if not SAMPLE_ID_RE.match(sample_id):
+        return None
+    meta = sample_index.get(sample_id)
+    if meta is None or meta['user'] != user:
+        return None
+    return meta
+
+
+def open_audio_upload(spool_path: str, max_bytes: int):
+    """
+    Return (stream, name, spooled_file) for an audio upload sent either as
+    multipart field "file" or as the raw request body. wave needs to seek past
+    chunks, so non-seekable bodies are spooled to spool_path first; the caller
+    closes and removes spooled_file when it is not None. Raises
+    RequestEntityTooLarge past max_bytes, Content-Length or not (chunked bodies).
+    """
+    upload = request.files.get('file')   # multipart parsing is bounded by MAX_CONTENT_LENGTH
+    if upload is not None:
+        stream = upload.stream
+        name = request.form.get('name') or upload.filename
+    else:
+        stream = request.stream
+        name = request.args.get('name')
+
+    spooled = None
+    if getattr(stream, 'seekable', lambda: False)():
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+        if size > max_bytes:
+            raise RequestEntityTooLarge()
+    else:
+        spooled = open(spool_path, 'w+b')
+        total = 0
+        while True:
+            block = stream.read(1 << 20)
+            if not block:
+                break
+            total += len(block)
+            if total > max_bytes:
+                spooled.close()
+                raise RequestEntityTooLarge()
+            spooled.write(block)
+        spooled.seek(0)
+        stream = spooled
+    return stream, name, spooled
+
+
+@app.route('/api/samples/<user>', methods=['GET'])
+def list_samples(user):
+    with sample_index_lock:
+        samples = [m for m in sample_index.values() if m['user'] == user]
+    samples.sort(key=lambda m: m['created'])
+    return jsonify(samples), 200
+
+
+@app.route('/api/samples/<user>', methods=['POST'])
+def upload_sample(user):
+    """
+    Upload a sample (multipart field "file", or the raw WAV as the request body).
+    Optional "name" form/query field; defaults to the uploaded filename.
+    """
+    if request.content_length and request.content_length > SAMPLE_MAX_UPLOAD:
+        return jsonify({"error": "Sample upload too large"}), 413
+
+    os.makedirs(SAMPLE_DIR, exist_ok=True)
+    sample_id = uuid.uuid4().hex
+    dest = _sample_path(sample_id)
+    tmp = dest + '.part'
+    spooled = None
+    try:
+        stream, name, spooled = open_audio_upload(tmp + '.src', SAMPLE_MAX_UPLOAD)
+        name = name or 'sample'
+        meta = decode_to_canonical(stream, tmp)
+        os.replace(tmp, dest)
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Sample upload too large"}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 415
+    except Exception as e:
+        print(f"[SAMPLES] Upload failed: {e}")
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if spooled is not None:
+            spooled.close()
+        for leftover in (tmp, tmp + '.src'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    meta.update({'id': sample_id, 'user': user, 'name': name, 'created': time.time()})
+    with sample_index_lock:
+        sample_index[sample_id] = meta
+        _write_sample_index()
+    return jsonify(meta), 201
+
+
+@app.route('/api/samples/<user>/<sample_id>', methods=['GET'])
+def get_sample_meta(user, sample_id):
+    meta = _get_sample(user, sample_id)
+    if meta is None:
+        return jsonify(None), 404
+    return jsonify(meta), 200
+
+
+@app.route('/api/samples/<user>/<sample_id>', methods=['DELETE'])
+def delete_sample(user, sample_id):
+    meta = _get_sample(user, sample_id)
+    if meta is None:
+        return jsonify(None), 404
+    with sample_index_lock:
+        sample_index.pop(sample_id, None)
+        _write_sample_index()
+    try:
+        os.remove(_sample_path(sample_id))
+    except FileNotFoundError:
+        pass
+    return jsonify({}), 200
+
+
+@app.route('/api/samples/<user>/<sample_id>/audio', methods=['GET'])
+def get_sample_audio(user, sample_id):
+    """
+    Serve the canonical WAV. Range requests get 206 partial responses, and the
+    file is handed to the WSGI server's file wrapper (sendfile where supported).
+    """
+    meta = _get_sample(user, sample_id)
+    if meta is None:
+        return jsonify(None), 404
+    response = send_file(_sample_path(sample_id), mimetype='audio/wav', conditional=True,
+                         etag=meta['sha256'], max_age=3600)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@app.route('/api/samples/<user>/<sample_id>/pcm', methods=['GET'])
+def get_sample_pcm(user, sample_id):
+    """
+    Raw interleaved 16-bit PCM for a frame range (?start=&count=), sliced from
+    the memory-mapped file so only the requested frames are read. At most
+    SAMPLE_PCM_MAX_FRAMES are returned per request (X-Frame-Count says how
+    many), and the slice is streamed in blocks rather than copied whole.
+    """
+    meta = _get_sample(user, sample_id)
+    if meta is None:
+        return jsonify(None), 404
+    try:
+        start = int(request.args.get('start', 0))
+        count = int(request.args.get('count', SAMPLE_PCM_MAX_FRAMES))
+    except ValueError:
+        return jsonify({"error": "start and count must be integers"}), 400
+    if start < 0 or count < 0 or start > meta['frames']:
+        return jsonify({"error": "Frame range out of bounds"}), 416
+
+    end = min(start + min(count, SAMPLE_PCM_MAX_FRAMES), meta['frames'])
+    pcm = sample_memmap(meta)
+
+    def blocks():
+        for offset in range(start, end, SAMPLE_READ_FRAMES):
+            yield pcm[offset:min(offset + SAMPLE_READ_FRAMES, end)].tobytes()
+
+    response = Response(blocks(), mimetype='application/octet-stream')
+    response.headers['Content-Length'] = str((end - start) * meta['channels'] * 2)
+    response.headers['X-Sample-Rate'] = str(meta['sampleRate'])
+    response.headers['X-Channels'] = str(meta['channels'])
+    response.headers['X-Frame-Start'] = str(start)
+    response.headers['X-Frame-Count'] = str(end - start)
+    return response
+
+
+load_sample_index()
+
+# --- NEW: STREAMING TEMPO / ONSET DETECTION ---
+ONSET_FRAME = 1024            # FFT size for the spectral-flux onset envelope
+ONSET_HOP = 512
+ACF_SMOOTHING = np.array([1, 2, 3, 2, 1]) / 9   # = ACF of a 3-frame box over the onset envelope
+ONSET_BAND_EDGES_HZ = [150, 300, 600, 1200, 2400, 4800, 9600]
+TEMPO_MIN_BPM = 60
+TEMPO_MAX_BPM = 200
+TEMPO_BASS_CUTOFF_HZ = 300    # kick and snare bodies; the envelope that settles the octave
+TEMPO_BASS_PERIODIC = 0.5     # bass peak-over-median contrast needed before it is trusted
+TEMPO_BASS_RATIO = 0.7        # a faster octave wins if its bass ACF is at least this share
+TEMPO_OCTAVE_MARGIN = 0.15    # distance from that share needed for full confidence
+TEMPO_MAX_UPLOAD = int(os.environ.get('TEMPO_MAX_UPLOAD_MB', 100)) * 1024 * 1024
+# Werkzeug's own cap, so multipart parsing and chunked bodies stop at the largest
+# upload limit (plus room for form framing); routes enforce their own limit below it
+app.config['MAX_CONTENT_LENGTH'] = max(SAMPLE_MAX_UPLOAD, TEMPO_MAX_UPLOAD) + (1 << 20)
+
+
+class StreamingTempoEstimator:
+    """
+    Spectral-flux onset detection + onset-envelope autocorrelation, fed one
+    block of mono audio at a time. Two envelopes are tracked: the sum over all
+    bands, which finds the periodicity, and the bass bands alone, which pick
+    the octave (kicks mark the beat; hats and snares also repeat at half and
+    double it). State is a handful of fixed-size arrays (one FFT frame of
+    carry, the previous spectrum, and one slowest-beat period of onset history
+    per envelope), so memory does not grow with the length of the clip.
+    """
+
+    def __init__(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self.fps = sample_rate / ONSET_HOP
+        self.min_lag = max(int(np.ceil(self.fps * 60 / TEMPO_MAX_BPM)), 1)
+        self.max_lag = int(np.ceil(self.fps * 60 / TEMPO_MIN_BPM)) + 1
+        self.window = np.hanning(ONSET_FRAME).astype(np.float32)
+        # Octave-ish bands, each averaged over its own bins so a kick's few low
+        # bins count as much as a hat's hundreds of high ones
+        freqs = np.fft.rfftfreq(ONSET_FRAME, 1 / sample_rate)
+        edges = np.searchsorted(freqs, ONSET_BAND_EDGES_HZ)
+        self.band_starts = np.unique(np.concatenate([[0], edges[edges < len(freqs)]]))
+        self.band_sizes = np.diff(np.append(self.band_starts, len(freqs)))
+        self.bass_bands = max(int(np.searchsorted(freqs[self.band_starts], TEMPO_BASS_CUTOFF_HZ)), 1)
+        self.carry = np.zeros(0, dtype=np.float32)
+        self.prev_spectrum = None
+        self.flux_mean = np.zeros(2)
+        self.acf_len = self.max_lag + 3   # smoothing reaches two lags past max_lag
+        # Row 0 is the all-band envelope, row 1 the bands below TEMPO_BASS_CUTOFF_HZ
+        self.history = np.zeros((2, self.acf_len - 1), dtype=np.float64)  # recent onset values
+        self.acf = np.zeros((2, self.acf_len), dtype=np.float64)
+        self.frames = 0
+        self.onsets = 0
+        self.samples = 0
+        self._prev_flux = 0.0
+        self._rising = False
+
+    def feed(self, block: np.ndarray):
+        self.samples += len(block)
+        buf = np.concatenate([self.carry, block]) if len(self.carry) else block
+        if len(buf) < ONSET_FRAME:
+            self.carry = buf
+            return
+        frames = np.lib.stride_tricks.sliding_window_view(buf, ONSET_FRAME)[::ONSET_HOP]
+        consumed = len(frames) * ONSET_HOP
+        self.carry = buf[consumed:]
+
+        spectra = np.log1p(100 * np.abs(np.fft.rfft(frames * self.window, axis=1)))
+        prev = spectra[0] if self.prev_spectrum is None else self.prev_spectrum
+        diffs = np.diff(np.vstack([prev[None, :], spectra]), axis=0)
+        band_flux = np.add.reduceat(np.maximum(diffs, 0), self.band_starts, axis=1) / self.band_sizes
+        flux = np.stack([band_flux.sum(axis=1), band_flux[:, :self.bass_bands].sum(axis=1)])
+        self.prev_spectrum = spectra[-1]
+        self._accumulate(flux)
+
+    def _accumulate(self, flux: np.ndarray):
+        # Remove a slowly moving mean so the autocorrelation measures periodicity, not loudness
+        onset = np.empty_like(flux)
+        for i, value in enumerate(flux.T):
+            self.flux_mean = self.flux_mean + 0.01 * (value - self.flux_mean) if self.frames + i else value
+            onset[:, i] = np.maximum(value - self.flux_mean, 0.0)
+            rising = value[0] > self._prev_flux
+            if self._rising and not rising and onset[0, i] > 0:
+                self.onsets += 1
+            self._rising, self._prev_flux = rising, value[0]
+
+        joined = np.concatenate([self.history, onset], axis=1)
+        n = onset.shape[1]
+        total = joined.shape[1]
+        tail = joined[:, -n:]
+        for lag in range(self.acf_len):
+            self.acf[:, lag] += np.einsum('ij,ij->i', tail, joined[:, total - n - lag:total - lag])
+        self.history = joined[:, -(self.acf_len - 1):]
+        self.frames += n
+
+    def result(self) -> Dict[str, Any]:
+        lags = np.arange(self.min_lag, self.max_lag + 1)
+        if self.frames < self.acf_len or self.acf[0, 0] <= 0:
+            return {'bpm': None, 'confidence': 0.0, 'onsets': self.onsets,
+                    'duration': self.samples / self.sample_rate}
+
+        # Beat periods rarely land on a whole hop, so let each lag borrow from its neighbours
+        acf, bass = (np.convolve(row / max(row[0], 1e-12), ACF_SMOOTHING, mode='same') for row in self.acf)
+        bpms = 60 * self.fps / lags
+        # Perceptual prior: prefer tempi near 120 BPM (one-octave log-Gaussian)
+        weighted = acf[lags] * np.exp(-0.5 * np.log2(bpms / 120) ** 2)
+        bass_peak = bass[lags].max()
+        steady_bass = bass_peak > 0 and 1 - np.median(bass[lags]) / bass_peak >= TEMPO_BASS_PERIODIC
+        if steady_bass:
+            # Off-beat lags (3:2, 4:3 of the beat) can still line up hats and snares,
+            # but not the kick
+            weighted *= np.clip(bass[lags] / bass_peak, 0.0, 1.0)
+        best = int(np.argmax(weighted))
+
+        # The prior can land on L/2 or 2L as easily as on the beat, so let the
+        # octave neighbours (2L only when in range) compete explicitly
+        candidates = sorted({best} | {
+            int(round(lag)) - self.min_lag for lag in (lags[best] / 2, lags[best] * 2)
+            if self.min_lag <= int(round(lag)) <= self.max_lag})
+        if steady_bass:
+            # Kicks and snare bodies mark the beat: take the shortest candidate whose
+            # bass repeats nearly as well as the strongest one. Each share that sat
+            # close to TEMPO_BASS_RATIO was a near coin-flip, so it caps confidence
+            share = bass[lags[candidates]] / bass[lags[candidates]].max()
+            pick = int(np.argmax(share >= TEMPO_BASS_RATIO))
+            close = [abs(s - TEMPO_BASS_RATIO) for s in share if s < 1.0]
+            separation = min(close, default=TEMPO_OCTAVE_MARGIN) / TEMPO_OCTAVE_MARGIN
+        else:
+            # No steady bass to go on; keep the prior's pick and report how close it was
+            scores = weighted[candidates]
+            pick = int(np.argmax(scores))
+            rival = np.delete(scores, pick)
+            separation = (1.0 - rival.max() / scores[pick]) / TEMPO_OCTAVE_MARGIN if len(rival) else 1.0
+        best = candidates[pick]
+
+        # Parabolic interpolation for sub-lag precision
+        offset = 0.0
+        if 0 < best < len(lags) - 1:
+            a, b, c = acf[lags[best] - 1], acf[lags[best]], acf[lags[best] + 1]
+            denom = a - 2 * b + c
+            if denom:
+                offset = float(np.clip(0.5 * (a - c) / denom, -0.5, 0.5))
+        bpm = 60 * self.fps / (lags[best] + offset)
+
+        # How far the winning lag stands above a typical lag, on a 0..1 scale,
+        # scaled down when the octave call was close
+        # (lag 0 smoothed over the ACF's mirror image is what a perfectly periodic
+        # envelope would score, so sparse hits that barely repeat stay low too)
+        peak = acf[lags[best]]
+        baseline = float(np.median(acf[lags]))
+        ceiling = float(ACF_SMOOTHING @ (self.acf[0] / self.acf[0, 0])[[2, 1, 0, 1, 2]])
+        salience = np.clip((1.0 - baseline / peak) * min(peak / ceiling, 1.0), 0.0, 1.0) if peak > 0 else 0.0
+        confidence = float(salience * np.clip(separation, 0.0, 1.0))
+        return {
+            'bpm': round(float(bpm), 2),
+            'confidence': round(confidence, 3),
+            'onsets': self.onsets,
+            'duration': self.samples / self.sample_rate,
+        }
+
+
+def detect_tempo(src) -> Dict[str, Any]:
+    """Run StreamingTempoEstimator over a PCM WAV stream in fixed-size blocks."""
+    try:
+        reader = wave.open(src, 'rb')
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Unsupported audio file (PCM WAV required): {e}")
+    with reader:
+        channels = reader.getnchannels()
+        width = reader.getsampwidth()
+        estimator = StreamingTempoEstimator(reader.getframerate())
+        while True:
+            raw = reader.readframes(SAMPLE_READ_FRAMES)
+            if not raw:
+                break
+            estimator.feed(_pcm_to_float(raw, width, channels).mean(axis=1))
+    return estimator.result()
+
+
+@app.route('/tempo/<user>/detect', methods=['POST'])
+def detect_user_tempo(user):
+    """
+    Estimate the tempo of an uploaded WAV clip (multipart "file" or raw body).
+    With ?store=true the rounded BPM is saved as the user's tempo, provided the
+    confidence is at least ?minConfidence (default 0.3).
+    """
+    if request.content_length and request.content_length > TEMPO_MAX_UPLOAD:
+        return jsonify({"error": "Audio upload too large"}), 413
+
+    spool_path = os.path.join(tempfile.gettempdir(), f'tempo-{uuid.uuid4().hex}.wav')
+    spooled = None
+    try:
+        stream, _, spooled = open_audio_upload(spool_path, TEMPO_MAX_UPLOAD)
+        result = detect_tempo(stream)
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Audio upload too large"}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 415
+    except Exception as e:
+        print(f"[TEMPO] Detection failed: {e}")
+        return jsonify({"error": str(e)}), 400
+    finally:
+        if spooled is not None:
+            spooled.close()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+
+    store = request.args.get('store', '').lower() in ('1', 'true', 'yes')
+    try:
+        min_confidence = float(request.args.get('minConfidence', 0.3))
+    except ValueError:
+        return jsonify({"error": "minConfidence must be a number"}), 400
+
+    result['stored'] = False
+    if store and result['bpm'] is not None and result['confidence'] >= min_confidence:
+        store_tempo(user, int(round(result['bpm'])))
+        result['stored'] = True
+    return jsonify(result), 200
+
+# --- NEW: BACKGROUND EXPORT JOBS (process pool) ---
+EXPORT_DIR = os.environ.get('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'daw-exports'))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', os.cpu_count() or 1))
+EXPORT_MAX_PENDING = int(os.environ.get('EXPORT_MAX_PENDING', EXPORT_WORKERS * 2))  # queued + running jobs
+EXPORT_MAX_ITEMS = int(os.environ.get('EXPORT_MAX_ITEMS', 100))                     # per job
+EXPORT_JOB_TIMEOUT = int(os.environ.get('EXPORT_JOB_TIMEOUT', 600))                 # seconds per job
+EXPORT_WORKER_MEMORY_MB = int(os.environ.get('EXPORT_WORKER_MEMORY_MB', 1024))      # address space per worker
+EXPORT_RETENTION = int(os.environ.get('EXPORT_RETENTION', 3600))                    # keep results this long
+EXPORT_STOP_FILE = '.stop'   # dropped in a job's directory to stop its running renders
+
+# General MIDI percussion notes for the DrumMachine rows
+GM_DRUM_NOTES = {'kick': 36, 'snare': 38, 'hihat': 42, 'clap': 39}
+MIDI_PPQ = 480
+
+export_jobs = {}   # job_id -> job state
+export_jobs_lock = threading.RLock()  # reentrant: cancelling a future runs its callback inline
+export_pool = None
+
+
+def _export_worker_init():
+    """Cap each render worker's address space so one job can't exhaust the host."""
+    try:
+        import resource
+        limit = EXPORT_WORKER_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        pass  # not supported on this platform
+
+
+def get_export_pool() -> ProcessPoolExecutor:
+    global export_pool
+    if export_pool is None:
+        export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, initializer=_export_worker_init)
+    return export_pool
+
+
+def _submit_export_renders(calls: list) -> list:
+    """Submit (item, fmt, path) renders; rebuild the pool once if a dead worker broke it."""
+    global export_pool
+    for attempt in range(2):
+        pool = get_export_pool()
+        futures = []
+        try:
+            for call in calls:
+                futures.append(pool.submit(render_export_item, *call))
+            return futures
+        except BrokenProcessPool:
+            for future in futures:
+                future.cancel()
+            print(f"[EXPORT] Render pool broken, rebuilding (attempt {attempt + 1})")
+            if export_pool is pool:
+                export_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+    raise BrokenProcessPool("export pool could not be rebuilt")
+
+
+def _midi_var_len(value: int) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def _write_midi(path: str, tempo: int, events: list):
+    """Write a type-0 MIDI file. events: (tick, status, data1, data2)."""
+    track = bytearray()
+    usec_per_quarter = min(max(int(60_000_000 / tempo), 1), 0xFFFFFF)  # the meta event holds 24 bits
+    track += b'\x00\xff\x51\x03' + struct.pack('>I', usec_per_quarter)[1:]
+    last = 0
+    for tick, status, d1, d2 in sorted(events, key=lambda e: (e[0], e[1] & 0xF0 != 0x80)):
+        track += _midi_var_len(tick - last) + bytes([status, d1, d2])
+        last = tick
+    track += b'\x00\xff\x2f\x00'
+    with open(path, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, MIDI_PPQ))
+        f.write(b'MTrk' + struct.pack('>I', len(track)) + track)
+
+
+def _write_wav(path: str, chunks: Iterator[np.ndarray]) -> int:
+    frames = 0
+    with wave.open(path, 'wb') as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(RENDER_SAMPLE_RATE)
+        for chunk in chunks:
+            writer.writeframesraw((np.clip(chunk, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+            frames += len(chunk)
+    return frames
+
+
+def _check_export_limits(item: Dict[str, Any]):
+    """Raise if the item's job ran out of time or was stopped. Cheap enough to call per chunk."""
+    if time.time() > item['deadline']:
+        raise TimeoutError(f"Job exceeded {EXPORT_JOB_TIMEOUT}s limit")
+    if os.path.exists(item['stopFile']):
+        raise RuntimeError("Job was stopped")
+
+
+def _limited_chunks(chunks: Iterator[np.ndarray], item: Dict[str, Any]) -> Iterator[np.ndarray]:
+    for chunk in chunks:
+        _check_export_limits(item)
+        yield chunk
+
+
+def render_export_item(item: Dict[str, Any], fmt: str, path: str) -> Dict[str, Any]:
+    """
+    Runs in a pool worker: render one pattern or synth preset to WAV or MIDI.
+    The job's deadline and stop file are checked before starting and between
+    render chunks, so a timed-out or cancelled job frees its worker promptly.
+    """
+    _check_export_limits(item)
+    try:
+        return _render_export_item(item, fmt, path)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+def _render_export_item(item: Dict[str, Any], fmt: str, path: str) -> Dict[str, Any]:
+    if item['type'] == 'pattern':
+        if fmt == 'wav':
+            chunks = render_pattern_chunks(item['pattern'], item['tempo'], item['loops'])
+            frames = _write_wav(path, _limited_chunks(chunks, item))
+            return {'name': item['name'], 'file': os.path.basename(path), 'seconds': frames / RENDER_SAMPLE_RATE}
+        step_ticks = MIDI_PPQ // 4
+        events = []
+        steps = max((len(row) for row in item['pattern']), default=0)
+        for loop in range(item['loops']):
+            for track, row in enumerate(item['pattern'][:len(DRUM_TRACKS)]):
+                note = GM_DRUM_NOTES[DRUM_TRACKS[track]]
+                for step, on in enumerate(row):
+                    if on:
+                        tick = (loop * steps + step) * step_ticks
+                        events.append((tick, 0x99, note, 100))
+                        events.append((tick + step_ticks // 2, 0x89, note, 0))
+        _write_midi(path, item['tempo'], events)
+        return {'name': item['name'], 'file': os.path.basename(path), 'notes': len(events) // 2}
+
+    params = item['params']
+    if fmt == 'wav':
+        frames = _write_wav(path, _limited_chunks(render_synth_chunks(params), item))
+        return {'name': item['name'], 'file': os.path.basename(path), 'seconds': frames / RENDER_SAMPLE_RATE}
+    frequency = max(float(params.get('frequency', 440)), 8.2)
+    note = int(np.clip(round(69 + 12 * np.log2(frequency / 440)), 0, 127))
+    velocity = int(np.clip(float(params.get('amplitude', 0.5)) * 127, 1, 127))
+    ticks = max(int(float(params.get('duration', 0.5)) * 2 * MIDI_PPQ), 1)  # at 120 BPM
+    _write_midi(path, 120, [(0, 0x90, note, velocity), (ticks, 0x80, note, 0)])
+    return {'name': item['name'], 'file': os.path.basename(path), 'note': note}
+
+
+def _public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'format': job['format'],
+        'progress': {'done': job['done'], 'total': len(job['items'])},
+        'files': job['files'],
+        'errors': job['errors'],
+        'created': job['created'],
+        'finished': job['finished'],
+    }
+
+
+def _finish_job(job: Dict[str, Any], status: str):
+    """Caller holds export_jobs_lock."""
+    if job['status'] in ('done', 'failed', 'cancelled'):
+        return
+    job['status'] = status
+    job['finished'] = time.time()
+    if status != 'done':
+        # Running items see this between chunks and bail out
+        open(os.path.join(job['dir'], EXPORT_STOP_FILE), 'w').close()
+    for future in job['futures']:
+        future.cancel()  # only stops items that haven't started
+
+
+def _job_holds_slot(job: Dict[str, Any]) -> bool:
+    """A job counts toward EXPORT_MAX_PENDING until none of its renders are still running."""
+    return job['status'] in ('queued', 'running') or any(not f.done() for f in job['futures'])
+
+
+def _package_export(job: Dict[str, Any], files: list):
+    """Zip the rendered files on its own thread, without holding export_jobs_lock."""
+    archive = os.path.join(job['dir'], 'export.zip')
+    try:
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+            for entry in files:
+                zf.write(os.path.join(job['dir'], entry['file']), entry['file'])
+    except OSError as e:
+        print(f"[EXPORT] Packaging {job['id']} failed: {e}")
+        with export_jobs_lock:
+            job['errors'].append(f"Could not build archive: {e}")
+            _finish_job(job, 'failed')
+        return
+    with export_jobs_lock:
+        # Cancelled or timed out while zipping: keep that status, drop the archive
+        if job['status'] in ('queued', 'running'):
+            job['result'] = archive
+            _finish_job(job, 'done')
+
+
+def _export_item_done(job_id: str, future):
+    with export_jobs_lock:
+        job = export_jobs.get(job_id)
+        if job is None or job['status'] not in ('queued', 'running'):
+            return
+        try:
+            job['files'].append(future.result())
+        except CancelledError:
+            return
+        except TimeoutError:
+            pass  # reported once for the whole job by the deadline check below
+        except Exception as e:
+            job['errors'].append(str(e) or type(e).__name__)
+        job['done'] += 1
+        job['status'] = 'running'
+        if time.time() > job['deadline']:
+            job['errors'].append(f"Job exceeded {EXPORT_JOB_TIMEOUT}s limit")
+            _finish_job(job, 'failed')
+            return
+        if job['done'] < len(job['items']):
+            return
+        if not job['files']:
+            _finish_job(job, 'failed')
+            return
+        files = list(job['files'])
+    # Done callbacks run on the pool's management thread; don't make it wait on disk I/O
+    threading.Thread(target=_package_export, args=(job, files), name=f'export-zip-{job_id[:8]}',
+                     daemon=True).start()
+
+
+def _expire_export_jobs():
+    """Drop finished jobs past retention and enforce the per-job time limit."""
+    now = time.time()
+    with export_jobs_lock:
+        for job_id, job in list(export_jobs.items()):
+            if job['status'] in ('queued', 'running') and now > job['deadline']:
+                job['errors'].append(f"Job exceeded {EXPORT_JOB_TIMEOUT}s limit")
+                _finish_job(job, 'failed')
+            if job['finished'] and now - job['finished'] > EXPORT_RETENTION and not _job_holds_slot(job):
+                shutil.rmtree(job['dir'], ignore_errors=True)
+                del export_jobs[job_id]
+
+
+def _resolve_export_items(user: str, data: Dict[str, Any]):
+    """Turn the request body into self-contained render items. Returns (items, error)."""
+    loops = data.get('loops', 1)
+    if not isinstance(loops, int) or isinstance(loops, bool) or not 1 <= loops <= 64:
+        return None, "loops must be an integer between 1 and 64"
+
+    requested = data.get('items')
+    if data.get('all'):
+        requested = [{'type': 'pattern', 'name': name} for name in user_patterns.get(user, {})]
+    if not isinstance(requested, list) or not requested:
+        return None, "items (or all: true) required"
+    if len(requested) > EXPORT_MAX_ITEMS:
+        return None, f"At most {EXPORT_MAX_ITEMS} items per export job"
+
+    items = []
+    for index, entry in enumerate(requested):
+        if not isinstance(entry, dict):
+            return None, f"Item {index} must be an object"
+        name = str(entry.get('name') or f'item-{index}')
+        if entry.get('type') == 'synth':
+            error = validate_synth_params(entry.get('params'))
+            if error:
+                return None, f"Item {index}: {error}"
+            items.append({'type': 'synth', 'name': name, 'params': entry['params']})
+            continue
+        pattern = entry.get('pattern')
+        if pattern is None:
+            pattern = user_patterns.get(user, {}).get(name)
+            if pattern is None:
+                return None, f"Pattern not found: {name}"
+        if not isinstance(pattern, list) or not all(isinstance(row, list) for row in pattern):
+            return None, f"Item {index}: pattern must be an array of arrays"
+        tempo = entry.get('tempo', user_tempos.get(user, 120))
+        if not valid_render_tempo(tempo):
+            return None, f"Item {index}: tempo must be an integer between {RENDER_MIN_TEMPO} and {RENDER_MAX_TEMPO}"
+        items.append({'type': 'pattern', 'name': name, 'pattern': pattern, 'tempo': tempo, 'loops': loops})
+    return items, None
+
+
+@app.route('/api/export/<user>', methods=['POST'])
+def submit_export(user):
+    """
+    Queue a bulk render. Body:
+      { "format": "wav|midi", "all": true }                      every saved pattern
+      { "format": "wav|midi", "items": [
+          {"type": "pattern", "name": "groove1"},                  saved pattern
+          {"type": "pattern", "name": "x", "pattern": [[...]], "tempo": 120},
+          {"type": "synth", "name": "bass", "params": {...}} ] }
+    Rendering happens on a process pool; poll GET /api/export/<user>/<id>.
+    """
+    data = request.get_json(silent=True) or {}
+    fmt = data.get('format', 'wav')
+    if fmt not in ('wav', 'midi'):
+        return jsonify({"error": "format must be wav or midi"}), 400
+    items, error = _resolve_export_items(user, data)
+    if error:
+        return jsonify({"error": error}), 400
+
+    _expire_export_jobs()
+    with export_jobs_lock:
+        active = sum(1 for j in export_jobs.values() if _job_holds_slot(j))
+        if active >= EXPORT_MAX_PENDING:
+            return jsonify({"error": "Export queue is full, try again later"}), 429
+
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(EXPORT_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        created = time.time()
+        job = {
+            'id': job_id, 'user': user, 'format': fmt, 'items': items, 'dir': job_dir,
+            'status': 'queued', 'done': 0, 'files': [], 'errors': [], 'futures': [],
+            'result': None, 'created': created, 'finished': None,
+            'deadline': created + EXPORT_JOB_TIMEOUT,
+        }
+
+        ext = 'wav' if fmt == 'wav' else 'mid'
+        limits = {'deadline': job['deadline'], 'stopFile': os.path.join(job_dir, EXPORT_STOP_FILE)}
+        calls = []
+        for index, item in enumerate(items):
+            safe = re.sub(r'[^A-Za-z0-9_.-]+', '_', item['name'])[:64]
+            calls.append((dict(item, **limits), fmt, os.path.join(job_dir, f'{index:03d}-{safe}.{ext}')))
+        try:
+            job['futures'] = _submit_export_renders(calls)
+        except BrokenProcessPool:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            return jsonify({"error": "Export workers unavailable, try again later"}), 503
+        # Only a fully submitted job takes a queue slot
+        export_jobs[job_id] = job
+
+    # Callbacks take the lock themselves, so attach them after releasing it
+    for future in job['futures']:
+        future.add_done_callback(lambda f, job_id=job_id: _export_item_done(job_id, f))
+    return jsonify(_public_job(job)), 202
+
+
+def _get_export_job(user: str, job_id: str):
+    _expire_export_jobs()
+    job = export_jobs.get(job_id)
+    if job is None or job['user'] != user:
+        return None
+    return job
+
+
+@app.route('/api/export/<user>/<job_id>', methods=['GET'])
+def export_status(user, job_id):
+    job = _get_export_job(user, job_id)
+    if job is None:
+        return jsonify(None), 404
+    return jsonify(_public_job(job)), 200
+
+
+@app.route('/api/export/<user>/<job_id>', methods=['DELETE'])
+def cancel_export(user, job_id):
+    job = _get_export_job(user, job_id)
+    if job is None:
+        return jsonify(None), 404
+    with export_jobs_lock:
+        _finish_job(job, 'cancelled')
+    return jsonify(_public_job(job)), 200
+
+
+@app.route('/api/export/<user>/<job_id>/result', methods=['GET'])
+def export_result(user, job_id):
+    job = _get_export_job(user, job_id)
+    if job is None:
+        return jsonify(None), 404
+    if job['status'] != 'done':
+        return jsonify({"error": f"Job is {job['status']}"}), 409
+    return send_file(job['result'], mimetype='application/zip', as_attachment=True,
+                     download_name=f'{user}-export-{job_id[:8]}.zip')
+
+# --- NEW: ON-DEMAND REQUEST PROFILING ---
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))   # fraction of requests to profile
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')                         # X-Profile-Token value that forces a profile
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'daw-profiles'))
+PROFILE_RECENT = 500   # request timings kept for /debug/slow-requests
+PROFILE_KEEP_PER_ROUTE = int(os.environ.get('PROFILE_KEEP_PER_ROUTE', 50))  # newest .folded files kept per route
+
+recent_requests = deque(maxlen=PROFILE_RECENT)
+
+
+class StackSampler:
+    """
+    One background thread that snapshots the stacks of request threads being
+    profiled every PROFILE_INTERVAL seconds. Unprofiled requests pay nothing;
+    profiled ones pay a stack walk per interval rather than a hook per call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}   # thread id -> Counter of collapsed stacks
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id: int):
+        with self.lock:
+            self.active[thread_id] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def stop(self, thread_id: int) -> Counter:
+        with self.lock:
+            return self.active.pop(thread_id, Counter())
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(PROFILE_INTERVAL)
+            with self.lock:
+                if not self.active:
+                    self.wake.clear()
+                    continue
+                frames = sys._current_frames()
+                for thread_id, counts in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counts[self._collapse(frame)] += 1
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+stack_sampler = StackSampler()
+
+
+def _profile_forced() -> bool:
+    header = request.headers.get('X-Profile-Token')
+    return bool(PROFILE_TOKEN and header and hmac.compare_digest(header, PROFILE_TOKEN))
+
+
+def _route_slug() -> str:
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    return f"{request.method}_{re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'}"
+
+
+@app.before_request
+def start_request_profile():
+    g.request_started = time.perf_counter()
+    g.profiled = _profile_forced() or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+    if g.profiled:
+        stack_sampler.start(threading.get_ident())
+
+
+@app.after_request
+def finish_request_profile(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    entry = {
+        'route': request.url_rule.rule if request.url_rule else None,
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'ms': round(elapsed_ms, 2),
+        'time': time.time(),
+        'profile': None,
+    }
+    if g.pop('profiled', False):
+        counts = stack_sampler.stop(threading.get_ident())
+        if counts:
+            entry['profile'] = _write_profile(counts)
+        response.headers['X-Profile-Samples'] = str(sum(counts.values()))
+    recent_requests.append(entry)
+    return response
+
+
+@app.teardown_request
+def abandon_request_profile(exc):
+    # after_request is skipped when a view raises; don't leave the thread registered
+    if g.pop('profiled', False):
+        stack_sampler.stop(threading.get_ident())
+
+
+def _write_profile(counts: Counter) -> str:
+    """Write collapsed stacks ("a;b;c N" lines, as flamegraph.pl expects) under PROFILE_DIR/<route>/."""
+    route_dir = os.path.join(PROFILE_DIR, _route_slug())
+    os.makedirs(route_dir, exist_ok=True)
+    path = os.path.join(route_dir, f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.folded")
+    with open(path, 'w') as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+    _prune_profiles(route_dir)
+    return path
+
+
+def _prune_profiles(route_dir: str):
+    """Delete all but the newest PROFILE_KEEP_PER_ROUTE profiles (names start with a ms timestamp)."""
+    profiles = sorted(name for name in os.listdir(route_dir) if name.endswith('.folded'))
+    for name in profiles[:max(len(profiles) - PROFILE_KEEP_PER_ROUTE, 0)]:
+        try:
+            os.remove(os.path.join(route_dir, name))
+        except FileNotFoundError:
+            pass  # a concurrent request pruned it first
+
+
+@app.route('/debug/slow-requests', methods=['GET'])
+def slow_requests():
+    """Slowest of the last PROFILE_RECENT requests (token holders or localhost only)."""
+    if not (_profile_forced() or request.remote_addr in ('127.0.0.1', '::1')):
+        return jsonify(None), 404
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    slowest = sorted(list(recent_requests), key=lambda e: e['ms'], reverse=True)[:limit]
+    return jsonify({
+        'sampleRate': PROFILE_SAMPLE_RATE,
+        'intervalMs': PROFILE_INTERVAL * 1000,
+        'profileDir': PROFILE_DIR,
+        'requests': slowest,
+    }), 200
+
 
 if __name__ == '__main__':
     # Use PORT env var if provided by the host (Cloud Run sets PORT=8080)
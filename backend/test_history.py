@@ -0,0 +1,123 @@
+"""Round trips for the edit-history diff/patch and HistoryStream. Run: cd backend && python -m pytest"""
+import copy
+import json
+import random
+
+import pytest
+
+import server
+from server import HistoryStream, json_diff, json_patch
+
+
+def typed(value):
+    """Canonical text that tells 1, 1.0 and True apart but ignores dict key order."""
+    return json.dumps(value, sort_keys=True)
+
+
+def round_trip(old, new):
+    ops = server._unpack(server._pack(json_diff(old, new)))  # as stored by HistoryStream
+    return json_patch(copy.deepcopy(old), ops)
+
+
+@pytest.mark.parametrize('old, new', [
+    # list growth and shrink, at the root and nested
+    ([1, 2], [1, 2, 3, 4]),
+    ([1, 2, 3, 4], [1]),
+    ([1, 2, 3], []),
+    ([[True, False], [False]], [[True, False, True, True], [False], [True]]),
+    ([[True, False, True], [False, True]], [[True], []]),
+    ({'rows': [[1, 2, 3], [4, 5]]}, {'rows': [[1, 9], [4, 5, 6, 7]]}),
+    # dict key deletion and insertion
+    ({'a': 1, 'b': 2}, {'a': 1}),
+    ({'a': 1, 'b': {'c': 1, 'd': 2}}, {'b': {'d': 3}, 'e': [1]}),
+    ([{'x': 1, 'y': 2}, {'z': 3}], [{'y': 2}, {}, {'w': 4}]),
+    # type changes
+    ({'a': [1, 2]}, {'a': {'0': 1}}),
+    ({'a': {'b': 1}}, {'a': [1]}),
+    ([1, 2], {'0': 1}),
+    ({'a': 1}, 'scalar'),
+    ('scalar', [1]),
+    ({'v': 1}, {'v': 1.0}),
+    ({'v': 1}, {'v': True}),
+    ({'v': None}, {'v': 0}),
+    ([0, 1], [False, True]),
+])
+def test_diff_patch_round_trip(old, new):
+    assert typed(round_trip(old, new)) == typed(new)
+
+
+def test_diff_patch_round_trip_random():
+    rng = random.Random(7)
+
+    def value(depth):
+        kind = rng.choice(['int', 'float', 'bool', 'str', 'none'] + (['list', 'dict'] * 2 if depth < 3 else []))
+        if kind == 'list':
+            return [value(depth + 1) for _ in range(rng.randint(0, 4))]
+        if kind == 'dict':
+            return {rng.choice('abcde'): value(depth + 1) for _ in range(rng.randint(0, 4))}
+        return {'int': lambda: rng.randint(0, 3), 'float': lambda: rng.choice([0.5, 1.0]),
+                'bool': lambda: rng.random() < 0.5, 'str': lambda: rng.choice('xy'), 'none': lambda: None}[kind]()
+
+    for _ in range(500):
+        old, new = value(0), value(0)
+        assert typed(round_trip(old, new)) == typed(new)
+
+
+def test_diff_of_equal_values_is_empty():
+    assert json_diff({'a': [1, {'b': 2}]}, {'a': [1, {'b': 2}]}) == []
+
+
+def test_stream_reads_every_revision(monkeypatch):
+    monkeypatch.setattr(server, 'HISTORY_SNAPSHOT_EVERY', 4)
+    monkeypatch.setattr(server, 'HISTORY_MAX_REVISIONS', 1000)
+    history = HistoryStream()
+    values, rows = [], [[False] * 16 for _ in range(4)]
+    for i in range(15):   # toggle a step, and now and then grow or shrink a row
+        row = rows[i % 4]
+        row[i % len(row)] = not row[i % len(row)]
+        if i % 5 == 2:
+            rows[1].append(True)
+        elif i % 5 == 4:
+            rows[2].pop()
+        values.append(copy.deepcopy(rows))
+    for i, value in enumerate(values):
+        assert history.append(value, {'n': i}) == i + 1
+    assert history.append(values[-1], {}) == len(values)   # unchanged value adds no revision
+    for i, value in enumerate(values):
+        assert history.get(i + 1) == value
+    assert any(not entry[0] for entry in history.entries)   # deltas were actually used
+
+
+def test_stream_records_type_only_change():
+    history = HistoryStream()
+    history.append({'v': [1, 0]}, {})
+    assert history.append({'v': [True, False]}, {}) == 2
+    assert typed(history.get(2)) == typed({'v': [True, False]})
+
+
+def test_stream_keeps_private_copy():
+    history = HistoryStream()
+    value = {'rows': [[True]]}
+    history.append(value, {})
+    value['rows'][0].append(False)
+    history.append(value, {})
+    assert history.get(1) == {'rows': [[True]]}
+    assert history.get(2) == {'rows': [[True, False]]}
+
+
+def test_trim_keeps_snapshot_at_front(monkeypatch):
+    monkeypatch.setattr(server, 'HISTORY_SNAPSHOT_EVERY', 4)
+    monkeypatch.setattr(server, 'HISTORY_MAX_REVISIONS', 10)
+    history = HistoryStream()
+    values = [{'step': i, 'rows': [[True] * 16, [False] * 16]} for i in range(37)]
+    for i, value in enumerate(values):
+        history.append(value, {})
+        assert len(history.entries) <= 10
+        assert history.entries[0][0], f"oldest entry after revision {i + 1} is a delta"
+    assert history.head == len(values)
+    assert history.base > 1
+    assert not all(entry[0] for entry in history.entries)   # deltas were actually used
+    for revision in range(history.base, history.head + 1):
+        assert history.get(revision) == values[revision - 1]
+    with pytest.raises(KeyError):
+        history.get(history.base - 1)
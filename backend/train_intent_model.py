@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Offline trainer for the /api/command intent classifier.
+
+Generates utterances for each plan shape the LLM prompt knows about
+(add/remove/mute/unmute, tempo:set, tempo:delta, key:set, swing:set) plus
+out-of-scope text, featurizes them with server.intent_features and fits a
+softmax regression with NumPy. Accuracy is measured on whole templates the
+model never saw, so it reflects new phrasings rather than new slot values;
+the model is then refit on every template and written to intent_model.npz,
+which server.py loads at startup.
+
+Usage:
+    python train_intent_model.py [output_path]
+"""
+
+import random
+import sys
+
+import numpy as np
+
+from server import INTENT_FEATURES, INTENT_LABELS, INTENT_MODEL_PATH, intent_features
+
+SEED = 7
+EPOCHS = 600
+LEARNING_RATE = 20.0
+L2 = 1e-4
+HOLD_OUT_FRACTION = 0.2    # share of each label's templates kept out of the accuracy run
+
+INSTRUMENTS = [
+    'kick', 'kick drum', 'kicks', 'bass drum', 'snare', 'snares', 'snare drum',
+    'hi hat', 'hi hats', 'hihat', 'hihats', 'hats', 'hi-hats', 'high hats',
+    'clap', 'claps', 'handclaps', '808', '808s', 'bass', 'bassline', 'sub bass',
+    'piano', 'keys', 'pad', 'pads', 'synth pad',
+]
+KEYS = ['C', 'G', 'A minor', 'E minor', 'a min', 'e min', 'Am', 'Em', 'C major', 'G major']
+PREFIXES = ['', '', '', 'please ', 'can you ', 'could you ', 'hey ', 'yo ', 'now ', "let's ", 'ok ']
+SUFFIXES = ['', '', '', ' please', ' now', ' thanks', ' for me', '!', ' a bit']
+
+TEMPLATES = {
+    'add': [
+        'add {a}{i}', 'add some {i}', 'put in {a}{i}', 'throw in some {i}', 'throw in {a}{i}',
+        'give me some {i}', 'i want {a}{i}', 'bring in the {i}', "let's have {a}{i}",
+        'drop in {a}{i}', 'layer some {i}', 'layer in {a}{i}', 'include {a}{i}', 'add more {i}',
+        'we need {a}{i}', 'insert {a}{i}', 'stick {a}{i} in there', 'more {i}',
+    ],
+    'remove': [
+        'remove the {i}', 'delete the {i}', 'get rid of the {i}', 'take out the {i}',
+        'take the {i} out', 'drop the {i}', 'lose the {i}', 'no more {i}', 'kill the {i}',
+        'clear the {i}', "i don't want the {i}", 'ditch the {i}', 'scrap the {i}', 'erase the {i}',
+        'pull the {i} out', 'remove {i}',
+    ],
+    'mute': [
+        'mute the {i}', 'mute {i}', 'silence the {i}', 'quiet the {i}', 'shut the {i} up',
+        'turn off the {i}', 'turn the {i} off', 'hush the {i}', 'switch off the {i}',
+        'cut the {i} for now', "i don't want to hear the {i}",
+    ],
+    'unmute': [
+        'unmute the {i}', 'unmute {i}', 'bring back the {i}', 'bring the {i} back',
+        'turn the {i} back on', 'turn on the {i}', 'switch the {i} back on', 'unsilence the {i}',
+        'let me hear the {i} again', 'restore the {i}', 'un-mute the {i}',
+    ],
+    'tempo:set': [
+        'set tempo to {n}', 'tempo {n}', 'make it {n} bpm', '{n} bpm', 'change the tempo to {n}',
+        'bpm to {n}', 'set the bpm at {n}', 'go to {n} beats per minute', 'tempo should be {n}',
+        'run it at {n}', 'set bpm {n}', 'i want {n} bpm', 'play at {n} bpm',
+    ],
+    'tempo:up': [
+        'increase tempo by {d}', 'speed it up', 'faster', 'make it faster', 'speed up by {d} bpm',
+        'bump the tempo up {d}', 'raise the bpm by {d}', 'a bit faster', 'up the tempo',
+        'increase the bpm', 'push the tempo up by {d}', 'go {d} bpm faster', 'quicker',
+        'pick up the pace', 'tempo up {d}',
+    ],
+    'tempo:down': [
+        'decrease tempo by {d}', 'slow it down', 'slower', 'make it slower', 'slow down by {d} bpm',
+        'lower the bpm by {d}', 'drop the tempo {d}', 'a little slower', 'reduce the tempo',
+        'bring the tempo down by {d}', 'go {d} bpm slower', 'tempo down {d}', 'take it down {d} bpm',
+        'chill the tempo out',
+    ],
+    'key:set': [
+        'set key to {k}', 'change the key to {k}', 'put it in {k}', 'key of {k}', 'switch to {k}',
+        'make it in {k}', 'transpose to {k}', 'use the key of {k}', 'key {k}', 'play in {k}',
+        'move it to {k}',
+    ],
+    'swing:set': [
+        'swing {p}%', 'add {p}% swing', 'set swing to {p}', 'give it {p} percent swing',
+        'swing it at {p}', '{p}% shuffle', 'shuffle {p}', 'swing amount {p}', 'more swing {p}%',
+        'put the swing at {p} percent', 'swing {p} percent',
+    ],
+    'unknown': [
+        'make it sound better', 'what is this', 'hello', 'save my project', 'play', 'stop',
+        'export to wav', 'make it jazzier', 'undo that', 'can you help me', 'how do i use this',
+        'generate a new beat', 'load my last pattern', 'who made this app', 'open settings',
+        'record a melody', 'what key is it in', 'how fast is it', 'is the kick too loud',
+        'make a song about cats', 'thanks', 'i love this', 'randomize everything',
+        'show me the mixer', 'turn up the volume', 'make it louder', 'reverb on everything',
+        'change the sound', 'copy this pattern', 'tell me a joke', 'what can you do',
+    ],
+}
+
+
+def fill(template: str, rng: random.Random) -> str:
+    text = template.format(
+        i=rng.choice(INSTRUMENTS),
+        a=rng.choice(['a ', 'an ', 'some ', '']),
+        n=rng.randint(40, 220),
+        d=rng.randint(1, 30),
+        k=rng.choice(KEYS),
+        p=rng.randint(50, 65),
+    )
+    text = rng.choice(PREFIXES) + text + rng.choice(SUFFIXES)
+    if rng.random() < 0.3:
+        text = text.capitalize()
+    return text
+
+
+def split_templates(rng: random.Random):
+    """Split each label's templates into (train, held_out) dicts, at least one held out."""
+    train_templates, held_out = {}, {}
+    for label, templates in TEMPLATES.items():
+        shuffled = rng.sample(templates, len(templates))
+        cut = max(1, round(len(shuffled) * HOLD_OUT_FRACTION))
+        held_out[label], train_templates[label] = shuffled[:cut], shuffled[cut:]
+    return train_templates, held_out
+
+
+def build_dataset(rng: random.Random, templates_by_label=TEMPLATES, per_template: int = 30):
+    texts, labels = [], []
+    for label, templates in templates_by_label.items():
+        for template in templates:
+            for _ in range(per_template):
+                texts.append(fill(template, rng))
+                labels.append(INTENT_LABELS.index(label))
+    return texts, np.array(labels)
+
+
+def featurize(texts):
+    X = np.zeros((len(texts), INTENT_FEATURES), dtype=np.float32)
+    for row, text in enumerate(texts):
+        indices, values = intent_features(text)
+        np.add.at(X[row], indices, values)
+    return X
+
+
+def train(X: np.ndarray, y: np.ndarray):
+    """Full-batch gradient descent on softmax cross-entropy with L2."""
+    n, classes = len(X), len(INTENT_LABELS)
+    W = np.zeros((X.shape[1], classes), dtype=np.float32)
+    b = np.zeros(classes, dtype=np.float32)
+    Y = np.eye(classes, dtype=np.float32)[y]
+    for epoch in range(EPOCHS):
+        logits = X @ W + b
+        logits -= logits.max(axis=1, keepdims=True)
+        P = np.exp(logits)
+        P /= P.sum(axis=1, keepdims=True)
+        grad = P - Y
+        W -= LEARNING_RATE * (X.T @ grad / n + L2 * W)
+        b -= LEARNING_RATE * grad.mean(axis=0)
+        if epoch % 100 == 0:
+            loss = -np.log(P[np.arange(n), y] + 1e-9).mean()
+            print(f"epoch {epoch:4d}  loss {loss:.4f}")
+    return W, b
+
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else INTENT_MODEL_PATH
+    rng = random.Random(SEED)
+
+    train_templates, held_out_templates = split_templates(rng)
+    texts, y = build_dataset(rng, train_templates)
+    W, b = train(featurize(texts), y)
+    held_out, y_held = build_dataset(random.Random(SEED + 1), held_out_templates, per_template=10)
+    accuracy = (np.argmax(featurize(held_out) @ W + b, axis=1) == y_held).mean()
+    print(f"held-out templates: {sum(map(len, held_out_templates.values()))}, accuracy {accuracy:.3f}")
+
+    texts, y = build_dataset(rng)
+    W, b = train(featurize(texts), y)
+    print(f"trained on {len(texts)} utterances from every template")
+
+    np.savez_compressed(output, weights=W, bias=b, labels=np.array(INTENT_LABELS))
+    print(f"wrote {output}")
+
+
+if __name__ == '__main__':
+    main()